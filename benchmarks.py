@@ -0,0 +1,987 @@
+import argparse
+import asyncio
+import gc
+import heapq
+import json
+import pickle
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from codec import decode_delta, encode_delta, iter_delta
+from compaction import CompactionScheduler
+from hashing import blake2b_hasher, builtin_hasher, sha256_hasher
+from merkle import IncompleteDelta, MerkleLog
+from metrics import MemorySink
+from persist import SegmentLog
+from runtime import LocalNetwork, Replica, TcpTransport
+
+
+def swap_with_concurrent_ops(log1, log2):
+    nodes_to_send, roots_to_send = log1.prepare_swap(log2.my_uuid)
+    nodes_to_send2, roots_to_send2, on_deliver = log2.respond_to_swap(log1.my_uuid, nodes_to_send, roots_to_send)
+    log2.add_node(log2.my_uuid * 1000)
+    log1.swap_final(log2.my_uuid, nodes_to_send2, roots_to_send2)
+    on_deliver()
+
+
+def swap_reconciled(log1, log2, false_positive_rate=0.001, sent=None, attempts=3):
+    ## log2 ships a Bloom filter of the hashes it holds before log1 prepares; log1 ships its own with the delta.
+    ## A false positive surfaces as IncompleteDelta before anything is applied; that phase is redone with a
+    ## freshly seeded filter, and after `attempts` tries without any filter.
+    def filtered(log, seed):
+        return log.held_filter(false_positive_rate, seed) if seed < attempts else None
+
+    def record(nodes, roots, bloom):
+        if sent is not None:
+            sent.append((nodes, roots, bloom))
+
+    seed = 0
+    while True:
+        filter2 = filtered(log2, seed)
+        nodes_to_send, roots_to_send = log1.prepare_swap(log2.my_uuid, peer_filter=filter2)
+        filter1 = filtered(log1, seed)
+        record(nodes_to_send, roots_to_send, filter1)
+        record(None, None, filter2)
+        try:
+            nodes_to_send2, roots_to_send2, on_deliver = log2.respond_to_swap(log1.my_uuid, nodes_to_send, roots_to_send, peer_filter=filter1, own_filter=filter2)
+            break
+        except IncompleteDelta:
+            seed += 1
+    log2.add_node(log2.my_uuid * 1000)
+
+    while True:
+        record(nodes_to_send2, roots_to_send2, None)
+        try:
+            log1.swap_final(log2.my_uuid, nodes_to_send2, roots_to_send2, own_filter=filter1)
+            break
+        except IncompleteDelta:
+            ## log2 already merged our delta; only its reply has to be redone
+            seed += 1
+            filter1 = filtered(log1, seed)
+            record(None, None, filter1)
+            nodes_to_send2, roots_to_send2, on_deliver = log2.respond_to_swap(log1.my_uuid, nodes_to_send, roots_to_send, peer_filter=filter1)
+    on_deliver()
+
+
+def swap_with_all_peers(log, peers):
+    ## one anti-entropy round from log against every peer, batched on the initiating side
+    deltas = log.prepare_swap_many([peer.my_uuid for peer in peers])
+    responses, deliveries = {}, []
+    for peer in peers:
+        nodes, roots, on_deliver = peer.respond_to_swap(log.my_uuid, *deltas[peer.my_uuid])
+        responses[peer.my_uuid] = (nodes, roots)
+        deliveries.append(on_deliver)
+    log.swap_final_many(responses)
+    for on_deliver in deliveries:
+        on_deliver()
+
+
+## (start step, end step, replica indices): swaps across the cut are dropped while the window is open
+DEFAULT_PARTITIONS = ((4000, 6000, (1, 2, 3)),)
+
+
+def _partitioned(partitions, t, i, j):
+    for start, end, side in partitions:
+        if start <= t < end and (i in side) != (j in side):
+            return True
+    return False
+
+
+def run_gossip_workload(logs, steps=25000, ops_to_gossip=300, seed=0, ops_per_step=3, fanout=None,
+                        partitions=DEFAULT_PARTITIONS, swap=swap_with_concurrent_ops, on_step=None):
+    ## the old MerkleLogTests.test_benchmark schedule: up to ops_per_step random writes a step, and every
+    ## replica gossips once per ops_to_gossip steps (staggered) with `fanout` random peers, all by default
+    rng = random.Random(seed)
+    n = len(logs)
+    timesteps = [(i + 1) * ops_to_gossip // n - 1 for i in range(n)]
+    ops = swaps = 0
+
+    for t in range(steps):
+        for _ in range(rng.randint(0, ops_per_step)):
+            i = rng.randrange(n)
+            logs[i].add_node(logs[i].my_uuid * 1000)
+            ops += 1
+
+        for i in range(n):
+            if timesteps[i] % ops_to_gossip == 0:
+                logs[i].add_node(logs[i].my_uuid * 1000)
+                peers = [j for j in range(n) if j != i]
+                if fanout is not None:
+                    peers = rng.sample(peers, min(fanout, len(peers)))
+                for j in peers:
+                    if not _partitioned(partitions, t, i, j):
+                        swap(logs[i], logs[j])
+                        swaps += 1
+                timesteps[i] += rng.randint(0, 2)
+                logs[i].add_node(logs[i].my_uuid * 1000)
+                ops += 2
+
+        for i in range(n):
+            timesteps[i] += 1
+        if on_step is not None:
+            on_step(t)
+    return ops, swaps
+
+
+def _percentile(ordered, q):
+    return ordered[int(q * (len(ordered) - 1))] if ordered else 0.0
+
+
+def simulate(replicas=5, steps=25000, ops_per_step=3, gossip_every=300, fanout=None,
+             partitions=DEFAULT_PARTITIONS, seed=0, sample_every=10, trace_memory=False):
+    uuids = list(range(1, replicas + 1))
+    logs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+
+    latencies = []
+
+    def timed_swap(log1, log2):
+        start = time.perf_counter()
+        swap_with_concurrent_ops(log1, log2)
+        latencies.append(time.perf_counter() - start)
+
+    sizes = []
+
+    def sample(t):
+        if t % sample_every == 0:
+            sizes.append(max(len(log.nodes) for log in logs))
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    ops, swaps = run_gossip_workload(logs, steps=steps, ops_to_gossip=gossip_every, seed=seed, ops_per_step=ops_per_step,
+                                     fanout=fanout, partitions=partitions, swap=timed_swap, on_step=sample)
+    elapsed = time.perf_counter() - start
+    traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    latencies.sort()
+    steady = sizes[len(sizes) // 2:]
+    return {
+        "config": {"replicas": replicas, "steps": steps, "ops_per_step": ops_per_step, "gossip_every": gossip_every,
+                   "fanout": fanout, "partitions": [list(p) for p in partitions], "seed": seed},
+        "seconds": elapsed,
+        "ops": ops,
+        "ops_per_second": ops / elapsed,
+        "swaps": swaps,
+        "swaps_per_second": swaps / elapsed,
+        "swap_latency_p50_us": _percentile(latencies, 0.5) * 1e6,
+        "swap_latency_p99_us": _percentile(latencies, 0.99) * 1e6,
+        "peak_nodes": max(sizes, default=0),
+        "steady_nodes": sum(steady) / len(steady) if steady else 0,
+        "total_compacted": [log.total_compacted for log in logs],
+        "traced_peak_bytes": traced_peak,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench_simulate(**options):
+    result = simulate(**options)
+    print("%d ops/s  %d swaps/s  swap p50 %.0fus p99 %.0fus  nodes peak %d steady %.0f  compacted %s" % (
+        result["ops_per_second"], result["swaps_per_second"], result["swap_latency_p50_us"], result["swap_latency_p99_us"],
+        result["peak_nodes"], result["steady_nodes"], result["total_compacted"]))
+    return result
+
+
+def _time_method(log, name, totals):
+    method = getattr(log, name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        result = method(*args, **kwargs)
+        totals[0] += time.perf_counter() - start
+        return result
+
+    setattr(log, name, timed)
+
+
+def bench_stability(steps=25000, seed=0, enable_compaction=False):
+    ## compaction is off by default so the unstable window (and so the stability work) keeps growing
+    uuids = [1, 2, 3, 4, 5]
+    results = {}
+    for incremental in (False, True):
+        logs = [MerkleLog(uuid, uuids, enable_compaction=enable_compaction, incremental_stability=incremental) for uuid in uuids]
+        totals = [0.0]
+        engine = "_update_stability_incremental" if incremental else "_update_stability_full"
+        for log in logs:
+            _time_method(log, engine, totals)
+
+        start = time.perf_counter()
+        run_gossip_workload(logs, steps=steps, seed=seed)
+        elapsed = time.perf_counter() - start
+
+        stable = [set(h for h, node in log.nodes.items() if node.is_stable()) | log.compacted for log in logs]
+        results[incremental] = (elapsed, totals[0], stable)
+        print("%-11s total %.2fs  stability %.2fs" % ("incremental" if incremental else "full", elapsed, totals[0]))
+
+    assert results[True][2] == results[False][2], "stable sets differ between engines"
+    return results
+
+
+def bench_compaction(rounds=20000, window=4000):
+    ## cost of finding and compacting cogs per window of total_compacted; it should not grow with history
+    logs = [MerkleLog(uuid, [1, 2, 3], enable_compaction=True) for uuid in (1, 2, 3)]
+    totals = [0.0]
+    for name in ("next_cog", "compact_log"):
+        _time_method(logs[0], name, totals)
+
+    rng = random.Random(0)
+    results = []
+    last_time, last_compacted = 0.0, 0
+    for t in range(rounds):
+        i = rng.randrange(3)
+        logs[i].add_node(t)
+        swap_with_concurrent_ops(logs[i], logs[(i + 1 + rng.randrange(2)) % 3])
+        if (t + 1) % window == 0:
+            compacted = logs[0].total_compacted
+            per_cog = (totals[0] - last_time) / max(compacted - last_compacted, 1)
+            results.append((compacted, per_cog))
+            print("total_compacted %6d  %6.1f us per cog  (%d compacted hashes held)" % (compacted, per_cog * 1e6, len(logs[0].compacted)))
+            last_time, last_compacted = totals[0], compacted
+    return results
+
+
+def bench_gossip_round(rounds=3000, writes_per_round=20, seed=0):
+    ## initiator-side CPU of a full round against the other four replicas, per peer vs batched
+    uuids = [1, 2, 3, 4, 5]
+    results = {}
+    for batched in (False, True):
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        totals = [0.0]
+        names = ("prepare_swap_many", "swap_final_many") if batched else ("prepare_swap", "swap_final")
+        for log in logs:
+            for name in names:
+                _time_method(log, name, totals)
+
+        rng = random.Random(seed)
+        for _ in range(rounds):
+            for _ in range(writes_per_round):
+                logs[rng.randrange(5)].add_node(rng.randrange(1 << 30))
+            i = rng.randrange(5)
+            peers = [log for j, log in enumerate(logs) if j != i]
+            if batched:
+                swap_with_all_peers(logs[i], peers)
+            else:
+                for peer in peers:
+                    nodes, roots = logs[i].prepare_swap(peer.my_uuid)
+                    nodes, roots, on_deliver = peer.respond_to_swap(logs[i].my_uuid, nodes, roots)
+                    logs[i].swap_final(peer.my_uuid, nodes, roots)
+                    on_deliver()
+        results[batched] = totals[0] / rounds
+        print("%-8s %.0f us per round" % ("batched" if batched else "per-peer", results[batched] * 1e6))
+    return results
+
+
+def bench_runtime(seconds=3.0, uuids=(1, 2, 3, 4, 5)):
+    ## swaps completed per second by one process running every replica, each gossiping with all peers
+    async def run(transport):
+        replicas = [Replica(MerkleLog(uuid, list(uuids), enable_compaction=True), transport) for uuid in uuids]
+        for replica in replicas:
+            await replica.start()
+        swaps = 0
+        deadline = time.perf_counter() + seconds
+        start = time.perf_counter()
+        while time.perf_counter() < deadline:
+            for replica in replicas:
+                replica.add_node(replica.uuid)
+            await asyncio.gather(*(replica.gossip() for replica in replicas))
+            swaps += len(replicas) * (len(replicas) - 1)
+        elapsed = time.perf_counter() - start
+        for replica in replicas:
+            await replica.close()
+        return swaps / elapsed
+
+    results = {}
+    for name, make_transport in (("local", LocalNetwork), ("tcp", lambda: TcpTransport({uuid: ("127.0.0.1", 0) for uuid in uuids}))):
+        results[name] = asyncio.run(run(make_transport()))
+        print("%-5s %8.0f swaps/s" % (name, results[name]))
+    return results
+
+
+def bench_reconcile(steps=25000, seed=0, replicas=5, ops_to_gossip=300):
+    ## bytes (codec deltas plus filters) and nodes sent per swap on the simulation workload, with and without filters
+    results = {}
+    for reconciled in (False, True):
+        sent = []
+
+        def swap(log1, log2):
+            if reconciled:
+                swap_reconciled(log1, log2, sent=sent)
+            else:
+                nodes_to_send, roots_to_send = log1.prepare_swap(log2.my_uuid)
+                nodes_to_send2, roots_to_send2, on_deliver = log2.respond_to_swap(log1.my_uuid, nodes_to_send, roots_to_send)
+                log2.add_node(log2.my_uuid * 1000)
+                log1.swap_final(log2.my_uuid, nodes_to_send2, roots_to_send2)
+                on_deliver()
+                sent.extend([(nodes_to_send, roots_to_send, None), (nodes_to_send2, roots_to_send2, None)])
+
+        uuids = list(range(1, replicas + 1))
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        _, swaps = run_gossip_workload(logs, steps=steps, ops_to_gossip=ops_to_gossip, seed=seed, swap=swap)
+        nodes = sum(len(n) for n, _, _ in sent if n is not None)
+        delta_bytes = sum(len(encode_delta(n, r)) for n, r, _ in sent if n is not None)
+        filter_bytes = sum(len(f.to_bytes()) for _, _, f in sent if f is not None)
+        results[reconciled] = {"swaps": swaps, "nodes_per_swap": nodes / swaps, "bytes_per_swap": (delta_bytes + filter_bytes) / swaps,
+                               "filter_bytes_per_swap": filter_bytes / swaps}
+        print("%-10s %6.1f nodes/swap  %8.0f bytes/swap (%.0f of it filters)" % (
+            "bloom" if reconciled else "roots only", nodes / swaps, (delta_bytes + filter_bytes) / swaps, filter_bytes / swaps))
+    return results
+
+
+def _build_uncompacted_log(n, compact_store, seed=0):
+    ## two replicas writing concurrently and merging every few writes, never compacted
+    rng = random.Random(seed)
+    log1 = MerkleLog(1, [1, 2], compact_store=compact_store)
+    log2 = MerkleLog(2, [1, 2], compact_store=compact_store)
+    for i in range(n // 2):
+        log1.add_node(rng.randrange(1 << 30))
+        log2.add_node(rng.randrange(1 << 30))
+        if i % 8 == 0:
+            swap_with_concurrent_ops(log1, log2)
+    return log2
+
+
+def bench_memory(n=50000):
+    results = {}
+    for compact_store in (False, True):
+        tracemalloc.start()
+        log = _build_uncompacted_log(n, compact_store)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results[compact_store] = used / len(log.nodes)
+        print("%-7s %d nodes  %.0f bytes/node" % ("compact" if compact_store else "dict", len(log.nodes), results[compact_store]))
+    return results
+
+
+HASHERS = {"builtin": builtin_hasher, "blake2b": blake2b_hasher, "sha256": sha256_hasher}
+
+
+def _chain_delta(n, hasher):
+    log = MerkleLog(1, [1, 2], hasher=hasher)
+    for i in range(n):
+        log.add_node(i)
+    return log.prepare_swap(2)
+
+
+def bench_hashing(n=100000):
+    results = {}
+    for name, hasher in HASHERS.items():
+        dependencies = (hasher([], 0),)
+        start = time.perf_counter()
+        for i in range(n):
+            hasher(dependencies, i)
+        hashes_per_sec = n / (time.perf_counter() - start)
+
+        ## a fresh receiver hashes every node once; one that already holds half the delta only hashes the rest
+        nodes, roots = _chain_delta(n, hasher)
+        receiver = MerkleLog(2, [1, 2], hasher=hasher)
+        start = time.perf_counter()
+        assert receiver._verify_delta(nodes)
+        fresh = n / (time.perf_counter() - start)
+
+        receiver._add_verified_nodes(dict(list(nodes.items())[: n // 2]))
+        start = time.perf_counter()
+        assert receiver._verify_delta(nodes)
+        half_known = n / (time.perf_counter() - start)
+
+        results[name] = (hashes_per_sec, fresh, half_known)
+        print("%-8s %9.0f hashes/s  verify %9.0f nodes/s  verify (half known) %9.0f nodes/s" % (name, hashes_per_sec, fresh, half_known))
+    return results
+
+
+def bench_verify(n=100000, workers=(1, 4, 8), chunk=4096):
+    ## one large swap hashed inline, then split across a process pool (hashlib keeps the GIL for node-sized inputs)
+    nodes, roots = _chain_delta(n, blake2b_hasher)
+    receiver = MerkleLog(2, [1, 2])
+    start = time.perf_counter()
+    receiver._verify_delta(nodes)
+    inline = n / (time.perf_counter() - start)
+    results = {"inline": inline}
+    print("inline     %9.0f nodes/s" % inline)
+    for count in workers:
+        with ProcessPoolExecutor(count) as executor:
+            receiver = MerkleLog(2, [1, 2], verify_executor=executor, verify_chunk=chunk)
+            receiver._verify_delta(_chain_delta(chunk + 1, blake2b_hasher)[0])  # start the workers
+            start = time.perf_counter()
+            receiver._verify_delta(nodes)
+            rate = n / (time.perf_counter() - start)
+        results[count] = rate
+        print("%d workers  %9.0f nodes/s  (%.2fx inline)" % (count, rate, rate / inline))
+    return results
+
+
+def _stream_delta(stream):
+    roots, _ = next(stream)
+    return stream, roots
+
+
+def bench_stream(n=100000, buffer=1024):
+    ## a catch-up sync from an encoded delta: decoded whole, or streamed through ingest in dependency order;
+    ## transient is the receiver's peak allocation above what it keeps once the swap is done
+    source = MerkleLog(1, [1, 2])
+    for i in range(n):
+        source.add_node(i)
+    nodes, roots = source.iter_swap(2)
+    payload = encode_delta(dict(nodes), roots)
+    results = {}
+    for name, swap in (("whole", lambda log: log.respond_to_swap(1, *decode_delta(payload))),
+                       ("stream", lambda log: log.respond_to_swap_stream(1, *_stream_delta(iter_delta(payload)), buffer=buffer))):
+        receiver = MerkleLog(2, [1, 2])
+        tracemalloc.start()
+        start = time.perf_counter()
+        swap(receiver)
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(receiver.nodes) == n + 1
+        results[name] = (n / elapsed, peak - current)
+        print("%-6s %d nodes  %8.0f nodes/s  transient %6.1f MB" % (name, n, n / elapsed, (peak - current) / 1e6))
+    return results
+
+
+def bench_snapshot(histories=(10000, 100000), live=1000):
+    ## a replica joining late: snapshot size and load time follow the live state, not how long the history is
+    results = {}
+    for n in histories:
+        uuids = [1, 2, 3]
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        rng = random.Random(0)
+        for t in range(n):
+            i = rng.randrange(3)
+            logs[i].add_node(t)
+            swap_with_concurrent_ops(logs[i], logs[(i + 1 + rng.randrange(2)) % 3])
+        ## an unstable tail that a far-behind replica still has to receive
+        for i in range(live):
+            logs[0].add_node(n + i)
+
+        start = time.perf_counter()
+        snapshot = logs[0].export_snapshot()
+        export = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = MerkleLog.from_snapshot(snapshot, 3, uuids, enable_compaction=True)
+        load = time.perf_counter() - start
+        assert set(loaded.nodes) == set(logs[0].nodes)
+        results[n] = (len(snapshot), export, load)
+        print("%6d history  %5d live nodes  snapshot %7d bytes  export %6.1fms  load %6.1fms" % (n, len(loaded.nodes), len(snapshot), export * 1000, load * 1000))
+    return results
+
+
+def bench_metrics(steps=10000, seed=0, repeats=3):
+    ## the gossip workload with instrumentation off and with an in-memory sink, then where the time went
+    results = {}
+    for name in ("off", "memory"):
+        best = float('inf')
+        for _ in range(repeats):
+            sink = MemorySink() if name == "memory" else None
+            logs = [MerkleLog(uuid, [1, 2, 3, 4, 5], enable_compaction=True, metrics=sink) for uuid in (1, 2, 3, 4, 5)]
+            start = time.perf_counter()
+            run_gossip_workload(logs, steps=steps, seed=seed)
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+        print("metrics %-6s %6.2fs" % (name, best))
+    print("overhead %.1f%%" % ((results["memory"] / results["off"] - 1) * 100))
+    for name, histogram in sorted(sink.histograms.items()):
+        print("  %-26s n=%-7d p50 <= %-9.3g p99 <= %-9.3g sum %.3g" % (name, histogram.count, histogram.quantile(0.5), histogram.quantile(0.99), histogram.sum))
+    for name, count in sorted(sink.counters.items()):
+        print("  %-26s %d" % (name, count))
+    return results
+
+
+def _walk_delta(log, other_uuid):
+    ## what prepare_swap computed before the per-peer pending sets: a walk from our roots to the peer's
+    other_roots = log.other_replica_roots[other_uuid]
+    hashes = log._bfs_from_roots_until(lambda x : x not in other_roots and not log.check_stable(x))
+    return { h:log.nodes[h] for h in hashes if h in log.nodes}
+
+
+def bench_prepare(window=12000, replicas=4, seed=0):
+    ## prepare_swap latency when every write is gossiped to a random peer while one replica stays silent,
+    ## so nothing stabilises and the unstable window keeps growing; both deltas are built from the same state
+    uuids = list(range(1, replicas + 2))
+    logs = [MerkleLog(uuid, uuids) for uuid in uuids[:replicas]]
+    rng = random.Random(seed)
+    report = window // 4
+    totals = {"walk": [0.0, 0], "pending": [0.0, 0]}
+    results = {}
+    for t in range(window):
+        i, j = rng.sample(range(replicas), 2)
+        logs[i].add_node(t)
+
+        start = time.perf_counter()
+        walked = _walk_delta(logs[i], logs[j].my_uuid)
+        middle = time.perf_counter()
+        nodes, roots = logs[i].prepare_swap(logs[j].my_uuid)
+        end = time.perf_counter()
+        totals["walk"][0] += middle - start
+        totals["walk"][1] += len(walked)
+        totals["pending"][0] += end - middle
+        totals["pending"][1] += len(nodes)
+
+        nodes, roots, on_deliver = logs[j].respond_to_swap(logs[i].my_uuid, nodes, roots)
+        logs[i].swap_final(logs[j].my_uuid, nodes, roots)
+        on_deliver()
+        if (t + 1) % report == 0:
+            for name, (elapsed, sent) in totals.items():
+                results[(name, t + 1)] = elapsed / report
+                print("%-7s unstable %6d  %8.1f us per prepare_swap  %6.1f nodes sent" % (name, len(logs[0].nodes), elapsed / report * 1e6, sent / report))
+            totals = {"walk": [0.0, 0], "pending": [0.0, 0]}
+    return results
+
+
+def bench_append(n=100000, burst=1000):
+    ## local write throughput, one add_node per value vs add_nodes per burst
+    results = {}
+    for compact_store in (False, True):
+        for name in ("add_node", "add_nodes"):
+            log = MerkleLog(1, [1, 2, 3], compact_store=compact_store)
+            start = time.perf_counter()
+            if name == "add_node":
+                for i in range(n):
+                    log.add_node(i)
+            else:
+                for i in range(0, n, burst):
+                    log.add_nodes(range(i, i + burst))
+            rate = n / (time.perf_counter() - start)
+            results[(compact_store, name)] = rate
+            print("%-7s %-9s %8.0f values/s" % ("compact" if compact_store else "dict", name, rate))
+    return results
+
+
+def bench_reachability(window=10000, replicas=4, queries=2000, seed=0):
+    ## happens_before over a large unstable window (one replica stays silent), chain index vs walking
+    ## dependencies, and what maintaining the index costs the writes and swaps that build the window
+    uuids = list(range(1, replicas + 2))
+    results = {}
+    for indexed in (False, True):
+        logs = [MerkleLog(uuid, uuids, reachability_index=indexed) for uuid in uuids[:replicas]]
+        rng = random.Random(seed)
+        start = time.perf_counter()
+        for t in range(window):
+            i, j = rng.sample(range(replicas), 2)
+            logs[i].add_node(t)
+            swap_with_concurrent_ops(logs[i], logs[j])
+        build = time.perf_counter() - start
+
+        log = logs[0]
+        held = list(log.nodes)
+        pairs = [(rng.choice(held), rng.choice(held)) for _ in range(queries)]
+        start = time.perf_counter()
+        answers = [log.happens_before(a, b) for a, b in pairs]
+        per_query = (time.perf_counter() - start) / queries
+        results[indexed] = (build, per_query, answers)
+        chains = log.reachability.chains() if indexed else 0
+        print("%-5s build %5.2fs  %9.1f us per happens_before  (%d nodes, %d chains)" % ("index" if indexed else "walk", build, per_query * 1e6, len(held), chains))
+    assert results[True][2] == results[False][2]
+    return { indexed : result[:2] for indexed, result in results.items() }
+
+
+def bench_vectorized(windows=(1000, 10000, 100000), replicas=4, burst=8, seed=0):
+    ## one update_stability over an unstable window of each size (one replica stays silent, then catches up
+    ## on the first half): the incremental engine, the full Python engine and the NumPy one over chain labels.
+    ## "idle" is a second pass with nothing new, what the full engines pay on every swap regardless
+    uuids = list(range(1, replicas + 2))
+    silent = uuids[-1]
+    logs = [MerkleLog(uuid, uuids) for uuid in uuids[:replicas]]
+    rng = random.Random(seed)
+    snapshots, midpoints = {}, {}
+    t = 0
+    while t < max(windows):
+        i, j = rng.sample(range(replicas), 2)
+        logs[i].add_nodes(range(t, t + burst))
+        swap_with_concurrent_ops(logs[i], logs[j])
+        t += burst
+        for window in windows:
+            if t >= window // 2 and window not in midpoints:
+                midpoints[window] = tuple(logs[0].roots)
+            if t >= window and window not in snapshots:
+                snapshots[window] = (logs[0].export_snapshot(), midpoints[window])
+
+    engines = (("incremental", {}), ("full", {"incremental_stability": False}),
+               ("numpy", {"incremental_stability": False, "vectorized_stability": True}))
+    results = {}
+    for window in windows:
+        snapshot, midpoint = snapshots[window]
+        stable = {}
+        for name, options in engines:
+            log = MerkleLog.from_snapshot(snapshot, 1, uuids, **options)
+            unstable = sum(1 for node in log.nodes.values() if not node.is_stable())
+            log._set_replica_roots(silent, set(midpoint))
+            start = time.perf_counter()
+            log.update_stability()
+            catch_up = time.perf_counter() - start
+            start = time.perf_counter()
+            log.update_stability()
+            idle = time.perf_counter() - start
+            stable[name] = set(hash for hash, node in log.nodes.items() if node.is_stable())
+            results[(name, window)] = (unstable, catch_up, idle)
+            print("%-11s %6d unstable  catch up %9.2f ms  idle %9.2f ms  (%d now stable)" % (name, unstable, catch_up * 1e3, idle * 1e3, unstable - sum(1 for node in log.nodes.values() if not node.is_stable())))
+        assert stable["incremental"] == stable["full"] == stable["numpy"]
+    return results
+
+
+def _min_hash_order(log):
+    ## what a reader without the view does: a fresh smallest-hash-first topological sort of everything held
+    genesis = log._get_genesis_node_hash()
+    nodes = { hash : node for hash, node in log.nodes.items() if hash != genesis }
+    waiting, dependents, ready = {}, {}, []
+    for hash, node in nodes.items():
+        unplaced = [d for d in node.dependencies if d in nodes]
+        for d in unplaced:
+            dependents.setdefault(d, []).append(hash)
+        if unplaced:
+            waiting[hash] = len(unplaced)
+        else:
+            ready.append(hash)
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        hash = heapq.heappop(ready)
+        order.append(hash)
+        for dependent in dependents.get(hash, ()):
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                heapq.heappush(ready, dependent)
+    return order
+
+
+def bench_view(steps=5000, replicas=4, burst=4, seed=0):
+    ## a reader following one replica's values after every write and swap: changes_since on the maintained
+    ## view against re-sorting the whole log, and what keeping the view up to date costs a gossip workload
+    uuids = list(range(1, replicas + 1))
+    results = {}
+    for ordered_view in (False, True):
+        logs = [MerkleLog(uuid, uuids, ordered_view=ordered_view) for uuid in uuids]
+        rng = random.Random(seed)
+        start = time.perf_counter()
+        for t in range(steps):
+            i, j = rng.sample(range(replicas), 2)
+            logs[i].add_nodes(range(t * burst, (t + 1) * burst))
+            swap_with_concurrent_ops(logs[i], logs[j])
+        results[("build", ordered_view)] = time.perf_counter() - start
+
+    cursor, read, rewound, applied = (0, 0), 0.0, 0, []
+    rng = random.Random(seed)
+    reader = MerkleLog(1, uuids, ordered_view=True)
+    for t in range(steps):
+        reader.add_nodes(range(t * burst, (t + 1) * burst))
+        swap_with_concurrent_ops(reader, logs[rng.randrange(1, replicas)])
+        start = time.perf_counter()
+        keep, entries, cursor = reader.view.changes_since(cursor)
+        read += time.perf_counter() - start
+        rewound += len(applied) - keep
+        del applied[keep:]
+        applied.extend(value for _, value in entries)
+    assert applied == list(reader.view)
+    start = time.perf_counter()
+    order = _min_hash_order(reader)
+    resort = time.perf_counter() - start
+    assert order == [hash for hash, _ in reader.view.entries()]
+
+    results["changes_since"] = read / steps
+    results["resort"] = resort
+    print("build without view %.2fs, with view %.2fs" % (results[("build", False)], results[("build", True)]))
+    print("changes_since %8.1f us per read (%d entries rewound over %d reads)" % (read / steps * 1e6, rewound, steps))
+    print("full re-sort  %8.1f us per read at %d nodes" % (resort * 1e6, len(order)))
+    return results
+
+
+def bench_background_compaction(steps=20000, partition=(5000, 10000), budget=256, seed=0):
+    ## swap latency when compaction runs in update_stability against a CompactionScheduler slice run
+    ## between swaps (as the event loop would). Replica 3 is cut off for a while, so the history it
+    ## missed becomes one large cog the moment it catches up
+    results = {}
+    for background in (False, True):
+        logs = [MerkleLog(uuid, [1, 2, 3], enable_compaction=not background) for uuid in (1, 2, 3)]
+        schedulers = [CompactionScheduler(log, budget=budget) for log in logs] if background else None
+        rng = random.Random(seed)
+        latencies, slices = [], []
+        for t in range(steps):
+            i = rng.randrange(3)
+            logs[i].add_node(t)
+            j = (i + 1 + rng.randrange(2)) % 3
+            if partition[0] <= t < partition[1] and 2 in (i, j):
+                continue
+            start = time.perf_counter()
+            swap_with_concurrent_ops(logs[i], logs[j])
+            latencies.append(time.perf_counter() - start)
+            if background:
+                start = time.perf_counter()
+                schedulers[i].run_slice()
+                slices.append(time.perf_counter() - start)
+        latencies.sort()
+        p50, p99, worst = _percentile(latencies, 0.5), _percentile(latencies, 0.99), latencies[-1]
+        results[background] = (p50, p99, worst, logs[0].total_compacted, len(logs[0].nodes))
+        print("%-10s swap p50 %6.1f us  p99 %7.1f us  max %8.1f us  (%d compactions, %d live nodes%s)" % (
+            "background" if background else "inline", p50 * 1e6, p99 * 1e6, worst * 1e6, logs[0].total_compacted, len(logs[0].nodes),
+            ", longest slice %.1f us" % (max(slices) * 1e6) if background else ""))
+    return results
+
+
+def bench_bulk_compaction(steps=8000, partition=4000, seed=0):
+    ## live nodes after a partition heals: one cog per update_stability against the whole stable prefix.
+    ## Replica 3 misses the first `partition` steps, so their history is only stable once it catches up
+    results = {}
+    for bulk in (False, True):
+        logs = [MerkleLog(uuid, [1, 2, 3], enable_compaction=True, bulk_compaction=bulk) for uuid in (1, 2, 3)]
+        totals = [0.0]
+        for name in ("next_cog", "stable_prefix", "compact_log"):
+            _time_method(logs[0], name, totals)
+        rng = random.Random(seed)
+        live, settled = [], None
+        for t in range(steps):
+            i = rng.randrange(3)
+            logs[i].add_node(t)
+            j = (i + 1 + rng.randrange(2)) % 3
+            if t < partition and 2 in (i, j):
+                continue
+            swap_with_concurrent_ops(logs[i], logs[j])
+            if t >= partition:
+                live.append(len(logs[0].nodes))
+                if settled is None and len(logs[0].nodes) < 100:
+                    settled = len(live)
+        results[bulk] = (live[0], max(live), live[-1], settled, totals[0])
+        print("%-4s live nodes at heal %5d  peak %5d  end %5d  below 100 after %s swaps  (%.2fs finding and compacting)" % (
+            "bulk" if bulk else "cog", live[0], max(live), live[-1], settled if settled is not None else "> %d" % len(live), totals[0]))
+    return results
+
+
+def bench_deletion(replicas=(5, 20, 40), steps=6000, seed=0):
+    ## compact_log per cog as the number of replicas grows: which compacted hashes can be deleted is what
+    ## scales with them (every hash a replica still has as a root stays)
+    results = {}
+    for n in replicas:
+        uuids = list(range(1, n + 1))
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True, bulk_compaction=True) for uuid in uuids]
+        totals = [0.0]
+        _time_method(logs[0], "compact_log", totals)
+        rng = random.Random(seed)
+        held = 0
+        for t in range(steps):
+            i = rng.randrange(n)
+            logs[i].add_node(t)
+            j = rng.choice([j for j in range(n) if j != i]) if rng.random() < 0.5 else 0
+            if i != j:
+                swap_with_concurrent_ops(logs[i], logs[j])
+            held = max(held, len(logs[0].compacted))
+        per_cog = totals[0] / max(logs[0].total_compacted, 1)
+        results[n] = (per_cog, logs[0].total_compacted, held)
+        print("%3d replicas  compact_log %7.1f us per call  (%d calls, up to %d compacted hashes held)" % (n, per_cog * 1e6, logs[0].total_compacted, held))
+    return results
+
+
+def _peer_state_bytes(log):
+    ## pending sets plus distinct root sets (shared frontiers counted once) and the bitmask per unstable node
+    pending = sum(sys.getsizeof(p) for p in log._pending_send.values())
+    roots = sum(sys.getsizeof(r) for r in {id(r): r for r in log.other_replica_roots.values()}.values())
+    return pending + roots + sys.getsizeof(log._seen_by) + sum(sys.getsizeof(m) for m in log._seen_by.values())
+
+
+def bench_cluster(replicas=(50, 100), steps=2000, fanout=8, seed=0):
+    ## many replicas, with pairwise swaps and with gossip rounds against `fanout` peers: time in
+    ## update_stability and prepare_swap and the per-peer state of one log, with per-peer pending
+    ## sets against large_cluster mode
+    results = {}
+    for n in replicas:
+        uuids = list(range(1, n + 1))
+        for workload in ("pairs", "rounds"):
+            for large_cluster in (False, True):
+                logs = [MerkleLog(uuid, uuids, enable_compaction=True, large_cluster=large_cluster) for uuid in uuids]
+                totals = { name : [0.0] for name in ("update_stability", "prepare_swap", "prepare_swap_many") }
+                for log in logs:
+                    for name, total in totals.items():
+                        _time_method(log, name, total)
+                rng = random.Random(seed)
+                peak = 0
+                start = time.perf_counter()
+                for t in range(steps if workload == "pairs" else steps // fanout):
+                    i = rng.randrange(n)
+                    logs[i].add_node(t)
+                    if workload == "pairs":
+                        swap_with_concurrent_ops(logs[i], logs[rng.choice([j for j in range(n) if j != i])])
+                    else:
+                        swap_with_all_peers(logs[i], [logs[j] for j in rng.sample([j for j in range(n) if j != i], fanout)])
+                    if t % 50 == 49:
+                        peak = max(peak, _peer_state_bytes(logs[0]))
+                elapsed = time.perf_counter() - start
+                prepare = totals["prepare_swap"][0] + totals["prepare_swap_many"][0]
+                log = logs[0]
+                results[(n, workload, large_cluster)] = (elapsed, totals["update_stability"][0], prepare, peak)
+                print("%3d replicas %-6s %-7s total %5.2fs  update_stability %5.2fs  prepare %5.2fs  peer state peak %6.0f KB  (%d frontiers for %d peers)" % (
+                    n, workload, "large" if large_cluster else "default", elapsed, totals["update_stability"][0], prepare, peak / 1024,
+                    len(log._frontiers), len(log.other_replica_roots)))
+    return results
+
+
+def bench_eviction(backlogs=(1000, 10000, 50000), burst=10, seed=0):
+    ## a dead replica holds back stability and compaction; remove_replica releases the backlog at once
+    results = {}
+    for backlog in backlogs:
+        logs = [MerkleLog(uuid, [1, 2, 3], enable_compaction=True) for uuid in (1, 2)]
+        rng = random.Random(seed)
+        for t in range(0, backlog, burst):
+            i = rng.randrange(2)
+            logs[i].add_nodes(range(t, t + burst))
+            swap_with_concurrent_ops(logs[i], logs[1 - i])
+        held = len(logs[0].nodes)
+        start = time.perf_counter()
+        logs[0].remove_replica(3)
+        elapsed = time.perf_counter() - start
+        results[backlog] = (held, len(logs[0].nodes), elapsed)
+        print("%6d writes behind a dead replica  live nodes %6d -> %3d  remove_replica %7.1f ms" % (backlog, held, len(logs[0].nodes), elapsed * 1e3))
+    return results
+
+
+def bench_codec(sizes=(1000, 10000, 100000)):
+    results = {}
+    for n in sizes:
+        nodes, roots = _chain_delta(n, blake2b_hasher)
+        for name, encode, decode in (("wire", lambda: encode_delta(nodes, roots), decode_delta),
+                                     ("pickle", lambda: pickle.dumps((nodes, roots), pickle.HIGHEST_PROTOCOL), pickle.loads)):
+            start = time.perf_counter()
+            payload = encode()
+            encode_rate = n / (time.perf_counter() - start)
+            start = time.perf_counter()
+            decode(payload)
+            decode_rate = n / (time.perf_counter() - start)
+            results[(name, n)] = (len(payload), encode_rate, decode_rate)
+            print("%-6s %6d nodes  %5.1f bytes/node  encode %8.0f nodes/s  decode %8.0f nodes/s" % (name, n, len(payload) / n, encode_rate, decode_rate))
+    return results
+
+
+def _fanout_delta(n):
+    ## n concurrent children of genesis, as a replica sees them after a wide partition heals
+    source = MerkleLog(2, [1, 2])
+    genesis = source._get_genesis_node_hash()
+    nodes = {}
+    for i in range(n):
+        node = source._make_node((genesis,), i)
+        nodes[node.digest] = node
+    return nodes, set(nodes)
+
+
+def bench_fanout(sizes=(1000, 5000, 20000)):
+    results = {}
+    for n in sizes:
+        nodes, roots = _fanout_delta(n)
+        for compact_store in (False, True):
+            log = MerkleLog(1, [1, 2], enable_compaction=True, compact_store=compact_store)
+            start = time.perf_counter()
+            log.swap_final(2, nodes, roots)
+            elapsed = time.perf_counter() - start
+            results[(compact_store, n)] = elapsed
+            print("%-7s %6d children  merge and compact %.3fs" % ("compact" if compact_store else "dict", n, elapsed))
+    return results
+
+
+def bench_persistence(n=200000, fsync_settings=(0, 1000, 100)):
+    results = {}
+    for fsync_every in fsync_settings:
+        directory = tempfile.mkdtemp()
+        try:
+            log = MerkleLog(1, [1, 2], storage=SegmentLog(directory, fsync_every=fsync_every))
+            start = time.perf_counter()
+            for i in range(n):
+                log.add_node(i)
+            log.storage.close()
+            append_rate = n / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            recovered = MerkleLog(1, [1, 2], storage=SegmentLog(directory))
+            recovery = time.perf_counter() - start
+            recovered.storage.close()
+            assert recovered.roots == log.roots
+
+            results[fsync_every] = (append_rate, recovery)
+            print("fsync every %-5s append %8.0f nodes/s  recover %d nodes in %.2fs" % (fsync_every or "-", append_rate, n, recovery))
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+BENCHMARKS = {
+    "simulate": bench_simulate,
+    "stability": bench_stability,
+    "compaction": bench_compaction,
+    "gossip_round": bench_gossip_round,
+    "memory": bench_memory,
+    "hashing": bench_hashing,
+    "verify": bench_verify,
+    "stream": bench_stream,
+    "snapshot": bench_snapshot,
+    "metrics": bench_metrics,
+    "prepare": bench_prepare,
+    "append": bench_append,
+    "reachability": bench_reachability,
+    "vectorized": bench_vectorized,
+    "view": bench_view,
+    "background_compaction": bench_background_compaction,
+    "bulk_compaction": bench_bulk_compaction,
+    "deletion": bench_deletion,
+    "cluster": bench_cluster,
+    "eviction": bench_eviction,
+    "codec": bench_codec,
+    "reconcile": bench_reconcile,
+    "persistence": bench_persistence,
+    "fanout": bench_fanout,
+    "runtime": bench_runtime,
+}
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def _parse_partition(text):
+    start, end, side = text.split(":")
+    return int(start), int(end), tuple(int(i) for i in side.split(","))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MerkleLog benchmarks; runs all of them when none are named")
+    parser.add_argument("benchmarks", nargs="*", choices=sorted(BENCHMARKS), metavar="benchmark")
+    parser.add_argument("--json", help="write every result, with the commit it was measured at, to this file")
+    simulation = parser.add_argument_group("simulate")
+    simulation.add_argument("--replicas", type=int, default=5)
+    simulation.add_argument("--steps", type=int, default=25000)
+    simulation.add_argument("--ops-per-step", type=int, default=3, help="random writes per step are drawn from 0..N")
+    simulation.add_argument("--gossip-every", type=int, default=300, help="steps between two gossip rounds of one replica")
+    simulation.add_argument("--fanout", type=int, default=None, help="peers per gossip round (default: all)")
+    simulation.add_argument("--partition", type=_parse_partition, action="append", metavar="START:END:I,J,...",
+                            help="cut replicas I,J,... off from the rest for steps [START, END); repeatable")
+    simulation.add_argument("--no-partition", action="store_true", help="drop the default partition window")
+    simulation.add_argument("--seed", type=int, default=0)
+    simulation.add_argument("--trace-memory", action="store_true", help="report tracemalloc peak (slower)")
+    args = parser.parse_args()
+
+    partitions = () if args.no_partition else tuple(args.partition or DEFAULT_PARTITIONS)
+    simulate_options = {"replicas": args.replicas, "steps": args.steps, "ops_per_step": args.ops_per_step,
+                        "gossip_every": args.gossip_every, "fanout": args.fanout, "partitions": partitions,
+                        "seed": args.seed, "trace_memory": args.trace_memory}
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        print("==", name)
+        results[name] = BENCHMARKS[name](**simulate_options) if name == "simulate" else BENCHMARKS[name]()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(_jsonable({"commit": _git_commit(), "results": results}), f, indent=2)
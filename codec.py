@@ -0,0 +1,135 @@
+import struct
+
+from hashing import decode_value, decode_varint, encode_value, encode_varint
+
+
+## delta layout (all counts and lengths are varints, every digest is digest_size bytes):
+##   magic "MLD" | version | digest_size
+##   root count | roots...
+##   node count | per node: digest | dependency count | dependencies... | value length | encoded value
+MAGIC = b'MLD'
+VERSION = 1
+
+
+class WireNode:
+    __slots__ = ('dependencies', 'value', 'digest')
+
+    def __init__(self, dependencies, value, digest):
+        self.dependencies = dependencies
+        self.value = value
+        self.digest = digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return str(self.value)
+
+
+def _digest_size(roots, nodes):
+    for digest in roots:
+        return len(digest)
+    for digest in nodes:
+        return len(digest)
+    return 0
+
+
+def _check_digest(digest, digest_size):
+    if type(digest) is not bytes or len(digest) != digest_size:
+        raise TypeError("wire format needs fixed-width bytes digests, got %r" % (digest,))
+    return digest
+
+
+def encode_delta(nodes, roots):
+    digest_size = _digest_size(roots, nodes)
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out.append(digest_size)
+
+    out += encode_varint(len(roots))
+    for root in roots:
+        out += _check_digest(root, digest_size)
+
+    out += encode_varint(len(nodes))
+    for digest, node in nodes.items():
+        out += _check_digest(digest, digest_size)
+        dependencies = node.dependencies
+        out += encode_varint(len(dependencies))
+        for dependency in dependencies:
+            out += _check_digest(dependency, digest_size)
+        value = encode_value(node.value)
+        out += encode_varint(len(value))
+        out += value
+    return bytes(out)
+
+
+def _read_header(buf):
+    if bytes(buf[:3]) != MAGIC or len(buf) < 5:
+        raise ValueError("not a delta")
+    if buf[3] != VERSION:
+        raise ValueError("unsupported delta version %d" % buf[3])
+    return buf[4], 5
+
+
+def _read_digest(buf, pos, digest_size):
+    end = pos + digest_size
+    if end > len(buf):
+        raise ValueError("truncated delta")
+    return bytes(buf[pos:end]), end
+
+
+def iter_delta(data):
+    ## yields (roots, None) first, then (digest, node) for every node, reading straight from the buffer
+    buf = memoryview(data)
+    size = len(buf)
+    try:
+        digest_size, pos = _read_header(buf)
+
+        count, pos = decode_varint(buf, pos)
+        roots = set()
+        for _ in range(count):
+            root, pos = _read_digest(buf, pos, digest_size)
+            roots.add(root)
+        yield roots, None
+
+        count, pos = decode_varint(buf, pos)
+        for _ in range(count):
+            end = pos + digest_size
+            if end >= size:
+                raise ValueError("truncated delta")
+            digest = bytes(buf[pos:end])
+            pos = end
+
+            dep_count = buf[pos]
+            if dep_count < 0x80:
+                pos += 1
+            else:
+                dep_count, pos = decode_varint(buf, pos)
+            end = pos + dep_count * digest_size
+            if end > size:
+                raise ValueError("truncated delta")
+            dependencies = tuple(bytes(buf[p:p + digest_size]) for p in range(pos, end, digest_size)) if dep_count > 1 else (bytes(buf[pos:end]),) if dep_count else ()
+            pos = end
+
+            length = buf[pos]
+            if length < 0x80:
+                pos += 1
+            else:
+                length, pos = decode_varint(buf, pos)
+            end = pos + length
+            value, value_end = decode_value(buf, pos)
+            if value_end != end:
+                raise ValueError("value length mismatch")
+            pos = end
+            yield digest, WireNode(dependencies, value, digest)
+    except (IndexError, struct.error) as e:
+        raise ValueError("truncated delta") from e
+
+    if pos != size:
+        raise ValueError("trailing bytes after delta")
+
+
+def decode_delta(data):
+    stream = iter_delta(data)
+    roots, _ = next(stream)
+    return dict(stream), roots
@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+
+class CompactionScheduler:
+    ## Runs compaction as an asyncio task next to the swaps instead of at the end of every update_stability.
+    ## Like every other log mutation in runtime.Replica it runs on the event loop, so a slice never
+    ## interleaves with add_node or a merge; slices are kept short (at most `budget` nodes and about
+    ## `slice_seconds`) and the task yields to the loop between them. The log must be built with
+    ## enable_compaction=False so update_stability leaves compaction to the scheduler.
+
+    def __init__(self, log, budget = 256, slice_seconds = 0.001, idle_seconds = 0.01):
+        if log.auto_compaction:
+            raise ValueError("the log already compacts in update_stability; build it with enable_compaction=False")
+        self.log = log
+        self.budget = budget
+        self.slice_seconds = slice_seconds
+        self.idle_seconds = idle_seconds
+        self._task = None
+
+    def run_slice(self):
+        ## one slice of compaction; returns the number of nodes compacted
+        done = 0
+        deadline = time.perf_counter() + self.slice_seconds
+        while done < self.budget:
+            compacted = self.log.compact_step(self.budget - done)
+            if not compacted:
+                break
+            done += compacted
+            if time.perf_counter() >= deadline:
+                break
+        return done
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(0 if self.run_slice() else self.idle_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,160 @@
+import hashlib
+import itertools
+import struct
+
+
+## deepest nesting of tuples and lists encode_value writes and decode_value reads; past it both raise
+## ValueError rather than run out of stack, whatever a peer sends
+MAX_DEPTH = 128
+
+
+def encode_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode_value_into(out, value, depth = 0):
+    ## type-tagged and length-prefixed so distinct values never share an encoding
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif type(value) is int:
+        data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+        out += b'I'
+        out += encode_varint(len(data))
+        out += data
+    elif type(value) is float:
+        out += b'D'
+        out += struct.pack('>d', value)
+    elif type(value) is str:
+        data = value.encode('utf-8')
+        out += b'S'
+        out += encode_varint(len(data))
+        out += data
+    elif type(value) is bytes:
+        out += b'B'
+        out += encode_varint(len(value))
+        out += value
+    elif type(value) in (tuple, list):
+        if depth == MAX_DEPTH:
+            raise ValueError("value nested deeper than %d levels" % MAX_DEPTH)
+        out += b'L'
+        out += encode_varint(len(value))
+        for item in value:
+            _encode_value_into(out, item, depth + 1)
+    else:
+        raise TypeError("cannot canonically encode value of type %s" % type(value).__name__)
+
+
+def encode_value(value):
+    out = bytearray()
+    _encode_value_into(out, value)
+    return bytes(out)
+
+
+def decode_value(buf, pos):
+    ## inverse of encode_value; reads from any bytes-like buffer (memoryview included) starting at pos
+    return _decode_value(buf, pos, 0)
+
+
+def _decode_value(buf, pos, depth):
+    tag = buf[pos]
+    pos += 1
+    if tag == 0x4e:
+        return None, pos
+    if tag == 0x54:
+        return True, pos
+    if tag == 0x46:
+        return False, pos
+    if tag == 0x44:
+        return struct.unpack_from('>d', buf, pos)[0], pos + 8
+    if tag == 0x4c:
+        if depth == MAX_DEPTH:
+            raise ValueError("value nested deeper than %d levels" % MAX_DEPTH)
+        length, pos = decode_varint(buf, pos)
+        items = []
+        for _ in range(length):
+            item, pos = _decode_value(buf, pos, depth + 1)
+            items.append(item)
+        return tuple(items), pos
+    length, pos = decode_varint(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise ValueError("truncated value")
+    if tag == 0x49:
+        return int.from_bytes(buf[pos:end], 'big', signed=True), end
+    if tag == 0x53:
+        return str(buf[pos:end], 'utf-8'), end
+    if tag == 0x42:
+        return bytes(buf[pos:end]), end
+    raise ValueError("unknown value tag %r" % chr(tag))
+
+
+def encode_node(dependencies, value):
+    out = bytearray(encode_varint(len(dependencies)))
+    for dependency in dependencies:
+        _encode_value_into(out, dependency)
+    _encode_value_into(out, value)
+    return bytes(out)
+
+
+## content hashers over encode_node: dependencies and value must be what encode_value accepts (None, bool,
+## int, float, str, bytes, and tuples or lists of them); anything else raises TypeError
+def blake2b_hasher(dependencies, value):
+    return hashlib.blake2b(encode_node(dependencies, value), digest_size=32).digest()
+
+
+def sha256_hasher(dependencies, value):
+    return hashlib.sha256(encode_node(dependencies, value)).digest()
+
+
+def hash_chain(hasher, dependencies, values):
+    ## digests of a chain over a sequence of values: the first node depends on `dependencies`, every later
+    ## one on its predecessor only, so for the content hashers that prefix is encoded once for the whole chain
+    if not values:
+        return []
+    digest = hasher(dependencies, values[0])
+    digests = [digest]
+    constructor = _CHAIN_HASHES.get(hasher)
+    if constructor is None:
+        for value in itertools.islice(values, 1, None):
+            digest = hasher((digest,), value)
+            digests.append(digest)
+        return digests
+    prefix = encode_varint(1) + b'B' + encode_varint(len(digest))
+    for value in itertools.islice(values, 1, None):
+        out = bytearray(prefix)
+        out += digest
+        _encode_value_into(out, value)
+        digest = constructor(out).digest()
+        digests.append(digest)
+    return digests
+
+
+def builtin_hasher(dependencies, value):
+    ## the original 64-bit, per-process hash; kept for comparison only
+    return hash((tuple(dependencies), value))
+
+
+_CHAIN_HASHES = {
+    blake2b_hasher: lambda data: hashlib.blake2b(data, digest_size=32),
+    sha256_hasher: hashlib.sha256,
+}
@@ -1,21 +1,57 @@
+import struct
 from collections import deque
-import bisect 
+from itertools import chain
+
+from hashing import blake2b_hasher, decode_value, encode_value, hash_chain
+from metrics import timed
+from reachability import ChainIndex, dependency_order
+from reconcile import BloomFilter
+from store import CompactNodeStore
+from view import OrderedView
 
 
 def h(x):
-    return x.__hash__()
+    return x.digest
+
+
+class BadDelta(Exception):
+    ## a received node whose content doesn't hash to the digest it was sent under
+    def __init__(self, hash):
+        super().__init__("Bad delta received: node %r does not match its hash" % (hash,))
+        self.hash = hash
+
+
+def _first_bad_node(hasher, items):
+    ## module level so a process pool can pickle it; items are (hash, dependencies, value)
+    for hash, dependencies, value in items:
+        if hasher(dependencies, value) != hash:
+            return hash
+    return None
+
+
+class IncompleteDelta(Exception):
+    ## a delta pruned against our Bloom filter skipped nodes we don't have (false positives);
+    ## raised before any state changes, so the swap can be redone without a filter.
+    ## A streamed delta raises it once the stream ends, after its complete prefix was inserted
+    def __init__(self, missing):
+        super().__init__("delta is missing %d node(s) our filter claimed" % len(missing))
+        self.missing = missing
 
 
 class MerkleLog:
     
     class _MerkleLogNode: 
-        def __init__(self, dependencies, value):
+        __slots__ = ('dependencies', 'value', 'stable', 'digest')
+        
+        def __init__(self, dependencies, value, hasher = blake2b_hasher, digest = None):
             self.dependencies = tuple(dependencies)
             self.value = value
             self.stable = False
+            ## computed once; receivers recompute it from (dependencies, value) when verifying
+            self.digest = hasher(self.dependencies, value) if digest is None else digest
         
         def __hash__(self) -> int:
-            return hash((self.dependencies, self.value))
+            return hash(self.digest)
             
         def is_stable(self):
             return self.stable
@@ -27,43 +63,106 @@ class MerkleLog:
             
         def __repr__(self) -> str:
             return str(self.value)
-    def __init__(self, my_uuid, other_replicas, enable_compaction = False): 
+    def __init__(self, my_uuid, other_replicas, enable_compaction = False, incremental_stability = True, compact_store = False, hasher = blake2b_hasher, storage = None, verify_executor = None, verify_chunk = 4096, metrics = None, reachability_index = False, vectorized_stability = False, ordered_view = False, bulk_compaction = False, large_cluster = False): 
         self.other_replicas = [r for r in other_replicas if r!=my_uuid]
         self.my_uuid = my_uuid
+        self.hasher = hasher
+        ## deltas with more than verify_chunk new nodes are hashed in chunks on this concurrent.futures executor
+        self.verify_executor = verify_executor
+        self.verify_chunk = verify_chunk
+        ## counters and timings go to this sink (see metrics.py); None turns instrumentation off
+        self.metrics = metrics
         
         genesis_node = self._construct_genesis_node()
         genesis_node.mark_stable()
         
-        self.other_replica_roots = { uuid : set([h(genesis_node)]) for uuid in self.other_replicas if uuid != self.my_uuid}
+        ## peers that converged on the same roots share one frozenset: frontier -> [frontier, replicas on it]
+        genesis_roots = frozenset([h(genesis_node)])
+        self.other_replica_roots = { uuid : genesis_roots for uuid in self.other_replicas if uuid != self.my_uuid}
+        self._frontiers = { genesis_roots : [genesis_roots, len(self.other_replica_roots)] } if self.other_replica_roots else {}
+        ## hash -> how many other replicas have it among their roots, so can_delete needn't look at every replica
+        self._root_refs = { h(genesis_node) : len(self.other_replica_roots) } if self.other_replica_roots else {}
         
-        self.nodes = {h(genesis_node) : genesis_node}
-        self.dependencies = {h(genesis_node): []}
-        self.dependents = {}
+        if compact_store:
+            self.nodes, self.dependencies, self.dependents = CompactNodeStore().views()
+        else:
+            self.nodes, self.dependencies, self.dependents = {}, {}, {}
+        self.nodes[h(genesis_node)] = genesis_node
+        self.dependencies[h(genesis_node)] = []
         self.roots = [h(genesis_node)]
         
         self.compacted = set([h(genesis_node)])
+        ## hashes that may have become deletable since the last compact_log: compacted ones, and ones that
+        ## left every replica's roots; compact_log checks these instead of all of compacted
+        self._delete_candidates = set()
         self.auto_compaction = enable_compaction
+        ## compact the whole stable prefix at once (stable_prefix) instead of one cog at a time
+        self.bulk_compaction = bulk_compaction
         
+        ## cogs (or stable prefixes) compacted, however many compact_step calls each took
         self.total_compacted = 0
+        ## rest of a cog that compact_step has started on, ancestors first
+        self._cog_backlog = deque()
+        ## live nodes whose dependencies are all compacted, kept up to date as nodes arrive and get compacted
+        self._compact_frontier = set()
+        ## chain labels of the live nodes, for happens_before / covered_by without walking dependencies
+        self.reachability = ChainIndex() if reachability_index or vectorized_stability else None
+        ## deterministic linearization of the values (view.py), updated as nodes are added or merged
+        self.view = OrderedView() if ordered_view else None
+        
+        ## incremental stability: unstable hash -> bitset of replicas known to hold it
+        self.incremental_stability = incremental_stability
+        self._replica_bits = { uuid : 1 << i for i, uuid in enumerate(dict.fromkeys(self.other_replicas)) }
+        self._bit_replicas = { bit : uuid for uuid, bit in self._replica_bits.items() }
+        self._all_replicas_mask = sum(self._replica_bits.values())
+        self._seen_by = {}
+        self._dirty_replicas = {}
+        ## per peer, the unstable nodes it isn't known to hold: what prepare_swap sends, kept in step with _seen_by.
+        ## large_cluster drops them, so per-peer state is one bit per unstable node; prepare_swap then walks
+        ## from the roots over the nodes missing the peer's bit
+        self.large_cluster = large_cluster
+        self._pending_send = {} if large_cluster else { uuid : set() for uuid in self._replica_bits }
+        ## full recomputation over the chain labels with NumPy (stability.py), for large unstable windows
+        self._vectorized = None
+        if vectorized_stability:
+            if incremental_stability:
+                raise ValueError("vectorized_stability replaces the full engine; pass incremental_stability=False")
+            from stability import VectorizedStability
+            self._vectorized = VectorizedStability(self.reachability)
+        
+        ## durable backend (persist.SegmentLog); existing segments are replayed before new writes are recorded
+        self.storage = None
+        if storage is not None:
+            storage.attach(self)
+            self.storage = storage
         
     def _exists(self, hash):
         return hash in self.compacted or hash in self.nodes
                 
+    def _make_node(self, dependencies, value, digest = None):
+        return self._MerkleLogNode(dependencies, value, self.hasher, digest)
+    
     def _construct_genesis_node(self):
-        return self._MerkleLogNode([], 0)
+        return self._make_node([], 0)
     
     def _get_genesis_node_hash(self):
         return h(self._construct_genesis_node())
     
     def _new_node(self, value):
         prev_roots = self.roots
-        new_node = self._MerkleLogNode(prev_roots, value)
+        new_node = self._make_node(prev_roots, value)
         new_node_hash = h(new_node)
         
         self._add_node_graph(new_node)
         self._add_node_reverse_graph(new_node)
         
         self.roots = [new_node_hash]
+        if self.view is not None:
+            self.view.insert(((new_node_hash, new_node),))
+        if self.storage is not None:
+            self.storage.append_node(new_node_hash, new_node, True)
+        if self.metrics is not None:
+            self.metrics.inc("nodes_added")
         return new_node_hash
         
     
@@ -72,29 +171,133 @@ class MerkleLog:
         self.nodes[node_hash] = node
 
         self.dependencies[node_hash] = node.dependencies
+        if self.reachability is not None:
+            self.reachability.add(node_hash, node.dependencies)
+            if self._vectorized is not None and not node.is_stable():
+                self._vectorized.add(node_hash)
+        if self.incremental_stability and not node.is_stable():
+            self._seen_by[node_hash] = 0
+            for pending in self._pending_send.values():
+                pending.add(node_hash)
         
     def _add_node_reverse_graph(self, node):
         node_hash = h(node)
         for dependencies in node.dependencies:
             if dependencies not in self.dependents:
-                self.dependents[dependencies] = []
-            bisect.insort(self.dependents[dependencies], node_hash) 
+                self.dependents[dependencies] = {}
+            self.dependents[dependencies][node_hash] = None
+        if any(d in self.compacted for d in node.dependencies) and self.solely_dependent_on_compact(node_hash):
+            self._compact_frontier.add(node_hash)
         
     def add_node(self, value):
+        ## value: None, bool, int, float, str, bytes, or tuples and lists of those (lists read back as tuples),
+        ## as hashing.encode_value takes them. Anything else (dict, set, other objects) raises TypeError, and
+        ## nesting past hashing.MAX_DEPTH raises ValueError; either way before the log changes
         return self._new_node(value)
+    
+    def add_nodes(self, values):
+        ## a chain of local writes in one call, the same DAG as add_node per value; returns the new hashes
+        values = list(values)
+        hashes = hash_chain(self.hasher, tuple(self.roots), values)
+        dependencies = self.roots
+        added = []
+        make_node, hasher, storage = self._MerkleLogNode, self.hasher, self.storage
+        for value, node_hash in zip(values, hashes):
+            node = make_node(dependencies, value, hasher, node_hash)
+            self._add_node_graph(node)
+            self._add_node_reverse_graph(node)
+            if storage is not None:
+                storage.append_node(node_hash, node, True)
+            added.append((node_hash, node))
+            dependencies = (node_hash,)
+        if not hashes:
+            return hashes
+        
+        self.roots = [hashes[-1]]
+        if self.view is not None:
+            self.view.insert(added)
+        if self.metrics is not None:
+            self.metrics.inc("nodes_added", len(hashes))
+        return hashes
                 
                        
     def _verify_delta(self, nodes):
-        return all([ h(node) == hash for hash, node in nodes.items()])
+        ## only nodes we don't hold yet are hashed; a known hash already names its content
+        items = [(hash, node.dependencies, node.value) for hash, node in nodes.items() if not self._exists(hash)]
+        chunk = self.verify_chunk
+        if self.verify_executor is None or len(items) <= chunk:
+            bad = _first_bad_node(self.hasher, items)
+        else:
+            chunks = [items[i:i + chunk] for i in range(0, len(items), chunk)]
+            bad = next((hash for hash in self.verify_executor.map(_first_bad_node, [self.hasher] * len(chunks), chunks) if hash is not None), None)
+        if bad is not None:
+            raise BadDelta(bad)
+        return True
     
     def _add_verified_nodes(self, nodes):
-        for hash, node in nodes.items():
+        added = []
+        ## the chain index labels a node from its dependencies' labels, and storage replays records in the
+        ## order they were appended, so dependencies go first either way
+        for hash in dependency_order(nodes):
+            node = nodes[hash]
             if not self._exists(hash):
-                copy_node = self._MerkleLogNode(node.dependencies, node.value)
-                self.nodes[hash] = copy_node 
+                copy_node = self._make_node(node.dependencies, node.value, hash)
                 self._add_node_graph(copy_node)
                 self._add_node_reverse_graph(copy_node)
+                if self.storage is not None:
+                    self.storage.append_node(hash, copy_node, False)
+                added.append((hash, copy_node))
+        if self.view is not None:
+            self.view.insert(added)
+        if self.metrics is not None:
+            self.metrics.inc("nodes_received", len(added))
         
+    def ingest_nodes(self, nodes, buffer = 1024):
+        ## nodes: iterable of (hash, node) with every node after its dependencies, e.g. from iter_swap or
+        ## codec.iter_delta; verified and inserted buffer nodes at a time, so memory doesn't grow with the delta.
+        ## A node with a dependency we don't hold is rejected; returns the unknown dependencies
+        unknown = set()
+        batch = {}
+        for hash, node in nodes:
+            if hash in batch or self._exists(hash):
+                continue
+            missing = [d for d in node.dependencies if d not in batch and not self._exists(d)]
+            if missing:
+                unknown.update(missing)
+                continue
+            batch[hash] = node
+            if len(batch) >= buffer:
+                self._verify_delta(batch)
+                self._add_verified_nodes(batch)
+                batch = {}
+        self._verify_delta(batch)
+        self._add_verified_nodes(batch)
+        return unknown
+    
+    def _ingest_stream(self, received_nodes, received_roots, buffer):
+        new_remote_roots = set(filter(lambda root: not self._exists(root), received_roots))
+        unknown = self.ingest_nodes(received_nodes, buffer)
+        ## rejected nodes are either ones we compacted and deleted, resent by a stale peer, or a real gap
+        if any(not self._exists(root) for root in new_remote_roots):
+            raise IncompleteDelta(set(filter(lambda d: not self._exists(d), unknown)))
+        return self._merge_roots(received_roots, new_remote_roots)
+        
+    def _needed_nodes(self, received_nodes, new_remote_roots):
+        ## a peer with stale knowledge of us may resend nodes we already compacted and deleted;
+        ## only nodes reachable from the new roots without passing through something we hold are new
+        needed = self._bfs_from_nodes_until_in(new_remote_roots, received_nodes, lambda x : not self._exists(x))
+        return { hash : node for hash, node in received_nodes.items() if hash in needed }
+    
+    def _bfs_from_nodes_until_in(self, nodes, graph, filter_fn):
+        queue = deque(nodes)
+        seen = set()
+        while queue:
+            n = queue.pop()
+            if n in graph and filter_fn(n) and n not in seen:
+                seen.add(n)
+                queue.extend(graph[n].dependencies)
+        return seen
+    
     def _bfs_from_roots_until(self, filter_fn):
         return self._bfs_from_nodes_until(self.roots, filter_fn)
         
@@ -106,73 +309,464 @@ class MerkleLog:
             if filter_fn(n) and n not in seen:
                 seen.add(n)
                 queue.extend(self.dependencies[n])    
+        if self.metrics is not None:
+            self.metrics.observe("bfs_nodes_visited", len(seen))
         return seen
     
-    def prepare_swap(self, other_uuid):
-        other_roots = self.other_replica_roots[other_uuid]
-        filter_fn = lambda x : x not in other_roots and not self.check_stable(x)
-        hashes_to_send = self._bfs_from_roots_until(filter_fn)
-        return  { h:self.nodes[h] for h in hashes_to_send if h in self.nodes}, set(self.roots)
+    def _iter_topological(self, roots, filter_fn):
+        ## the nodes _bfs_from_nodes_until would collect, yielded lazily with dependencies first
+        seen = set()
+        for root in roots:
+            if root in seen or not filter_fn(root):
+                continue
+            seen.add(root)
+            stack = [(root, iter(self.dependencies[root]))]
+            while stack:
+                n, pending = stack[-1]
+                for d in pending:
+                    if d not in seen and filter_fn(d):
+                        seen.add(d)
+                        stack.append((d, iter(self.dependencies[d])))
+                        break
+                else:
+                    stack.pop()
+                    if n in self.nodes:
+                        yield n, self.nodes[n]
+    
+    def held_filter(self, false_positive_rate = 0.001, seed = 0):
+        ## every node a peer might still send us, stable ones included since the peer may not know that yet;
+        ## holding a node means holding its ancestors, so the peer's walk can stop at anything in here
+        return BloomFilter.of(chain(self.nodes, self.compacted), false_positive_rate, seed)
+    
+    def _check_complete(self, received_nodes, received_roots, own_filter):
+        ## anything the delta needs that we lack and that our filter claimed was pruned by a false positive;
+        ## needed nodes outside the filter were stable for the sender and may just be deleted here
+        if own_filter is None:
+            return
+        missing = set()
+        seen = set()
+        stack = [root for root in received_roots if not self._exists(root)]
+        while stack:
+            n = stack.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            node = received_nodes.get(n)
+            if node is None:
+                if n in own_filter:
+                    missing.add(n)
+                continue
+            stack.extend(d for d in node.dependencies if not self._exists(d))
+        if missing:
+            raise IncompleteDelta(missing)
+    
+    def _pending_for(self, other_uuid):
+        ## replica roots set since the last update_stability haven't been propagated into the pending sets yet
+        if self._dirty_replicas:
+            self._update_stability_incremental()
+        if self.large_cluster:
+            return self._bfs_from_roots_until(self._unseen_by(other_uuid))
+        return self._pending_send[other_uuid]
+    
+    def _unseen_by(self, other_uuid):
+        bit = self._replica_bits[other_uuid]
+        seen_by = self._seen_by
+        return lambda x : not seen_by.get(x, bit) & bit
+    
+    def _swap_filter(self, other_uuid, peer_filter):
+        if self.incremental_stability and self.large_cluster:
+            if self._dirty_replicas:
+                self._update_stability_incremental()
+            unsent = self._unseen_by(other_uuid)
+        elif self.incremental_stability:
+            ## descendants of a pending node are pending too, so a walk over pending nodes from the roots reaches them all
+            pending = self._pending_for(other_uuid)
+            unsent = pending.__contains__
+        else:
+            other_roots = self.other_replica_roots[other_uuid]
+            unsent = lambda x : x not in other_roots and not self.check_stable(x)
+        if peer_filter is None:
+            return unsent
+        return lambda x : unsent(x) and x not in peer_filter
+    
+    @timed("prepare_swap")
+    def prepare_swap(self, other_uuid, peer_filter = None):
+        if self.incremental_stability and peer_filter is None:
+            return self._delta(self._pending_for(other_uuid)), set(self.roots)
+        hashes_to_send = self._bfs_from_roots_until(self._swap_filter(other_uuid, peer_filter))
+        return  self._delta(hashes_to_send), set(self.roots)
     
+    def _delta(self, hashes_to_send):
+        delta = { h:self.nodes[h] for h in hashes_to_send if h in self.nodes}
+        if self.metrics is not None:
+            self.metrics.observe("delta_nodes_sent", len(delta))
+        return delta
+    
+    def iter_swap(self, other_uuid, peer_filter = None):
+        ## prepare_swap's delta as a lazy iterator in dependency order; consume it before mutating the log
+        return self._iter_topological(tuple(self.roots), self._swap_filter(other_uuid, peer_filter)), set(self.roots)
+
+    @timed("prepare_swap_many")
+    def prepare_swap_many(self, other_uuids):
+        roots = set(self.roots)
+        if self.incremental_stability:
+            return { uuid : (self._delta(self._pending_for(uuid)), roots) for uuid in other_uuids }
+        
+        ## one walk of the unstable subgraph carrying a bitset of the peers each node still has to go to;
+        ## a peer's bit stops at its own roots, which is where prepare_swap's walk for that peer stops
+        pinned = {}
+        wanted = 0
+        for uuid in other_uuids:
+            bit = self._replica_bits[uuid]
+            wanted |= bit
+            for root in self.other_replica_roots[uuid]:
+                pinned[root] = pinned.get(root, 0) | bit
+
+        send_to = {}
+        stack = [(root, wanted) for root in self.roots]
+        while stack:
+            n, bits = stack.pop()
+            bits &= ~pinned.get(n, 0) & ~send_to.get(n, 0)
+            if not bits or self.check_stable(n):
+                continue
+            send_to[n] = send_to.get(n, 0) | bits
+            stack.extend((d, bits) for d in self.dependencies[n])
+        if self.metrics is not None:
+            self.metrics.observe("bfs_nodes_visited", len(send_to))
+
+        deltas = {}
+        for uuid in other_uuids:
+            bit = self._replica_bits[uuid]
+            deltas[uuid] = self._delta(h for h, bits in send_to.items() if bits & bit), roots
+        return deltas
+
     def is_root(self, hash):
         return hash not in self.dependents
     
     def _determine_new_roots(self, received_nodes, received_roots):
-        root_same = received_roots.intersection(set(self.roots))
         ## new roots that haven't been seen before MUST be new roots of common subgraph
         new_remote_roots = set(filter(lambda root: not self._exists(root), received_roots))
         if new_remote_roots:        
-            self._add_verified_nodes(received_nodes)
+            self._add_verified_nodes(self._needed_nodes(received_nodes, new_remote_roots))
+        return self._merge_roots(received_roots, new_remote_roots)
+    
+    def _merge_roots(self, received_roots, new_remote_roots):
+        root_same = received_roots.intersection(set(self.roots))
         ## old roots that don't have dependents in new subgraph will stay as roots
         kept_local_roots = set(filter(self.is_root, self.roots))
         return root_same.union(new_remote_roots).union(kept_local_roots)
     
-    def respond_to_swap(self,other_uuid, received_nodes, received_roots):
-        if not self._verify_delta(received_nodes):
-            raise Exception("Bad delta received")
+    @timed("respond_to_swap")
+    def respond_to_swap(self,other_uuid, received_nodes, received_roots, peer_filter = None, own_filter = None):
+        ## peer_filter: the initiator's held_filter, to prune our reply;
+        ## own_filter: the filter we gave the initiator for its prepare_swap, to detect false positives
+        self._check_member(other_uuid)
+        if self.metrics is not None:
+            self.metrics.observe("delta_nodes_received", len(received_nodes))
+        self._verify_delta(received_nodes)
+        self._check_complete(received_nodes, received_roots, own_filter)
         
         new_roots = self._determine_new_roots(received_nodes, received_roots)
+        hashes_to_send = self._bfs_from_roots_until(self._reply_filter(other_uuid, received_roots, peer_filter))
+        on_deliver = self._responded(other_uuid, new_roots)
+        return self._delta(hashes_to_send), new_roots, on_deliver
     
-        filter_fn = lambda x :  not self.check_stable(x) and x not in self.other_replica_roots[other_uuid] and x not in received_roots
-        hashes_to_send = self._bfs_from_roots_until(filter_fn)
-
-        self.roots = tuple(new_roots)
+    @timed("respond_to_swap_stream")
+    def respond_to_swap_stream(self, other_uuid, received_nodes, received_roots, peer_filter = None, buffer = 1024):
+        ## respond_to_swap over an iterator of nodes in dependency order; the reply is lazy as well
+        self._check_member(other_uuid)
+        new_roots = self._ingest_stream(received_nodes, received_roots, buffer)
+        reply = self._iter_topological(self.roots, self._reply_filter(other_uuid, received_roots, peer_filter))
+        on_deliver = self._responded(other_uuid, new_roots)
+        return reply, new_roots, on_deliver
+    
+    def _reply_filter(self, other_uuid, received_roots, peer_filter):
+        unsent = self._swap_filter(other_uuid, peer_filter)
+        return lambda x : x not in received_roots and unsent(x)
+    
+    def _responded(self, other_uuid, new_roots):
+        self.roots = tuple(sorted(new_roots))
+        if self.storage is not None:
+            self.storage.append_roots(self.roots)
         
         def on_deliver():
-            self.other_replica_roots[other_uuid] = new_roots
-            self.update_stability()
-    
-        return { h:self.nodes[h] for h in hashes_to_send if h in self.nodes}, new_roots, on_deliver 
+            ## the peer may have been removed while the reply was on its way
+            if other_uuid in self.other_replica_roots:
+                self._set_replica_roots(other_uuid, new_roots)
+                self.update_stability()
+        return on_deliver
         
-    def swap_final(self, other_uuid, received_nodes, received_roots):
-        if not self._verify_delta(received_nodes):
-            raise Exception("Bad delta received")
-            
-        self.other_replica_roots[other_uuid] = received_roots
-        new_roots = self._determine_new_roots(received_nodes, received_roots)
-        self.roots = tuple(new_roots)
+    @timed("swap_final")
+    def swap_final(self, other_uuid, received_nodes, received_roots, own_filter = None):
+        self._check_member(other_uuid)
+        if self.metrics is not None:
+            self.metrics.observe("delta_nodes_received", len(received_nodes))
+        self._verify_delta(received_nodes)
+        self._check_complete(received_nodes, received_roots, own_filter)
+        self._finish_swap(other_uuid, received_roots, self._determine_new_roots(received_nodes, received_roots))
+    
+    @timed("swap_final_stream")
+    def swap_final_stream(self, other_uuid, received_nodes, received_roots, buffer = 1024):
+        self._check_member(other_uuid)
+        self._finish_swap(other_uuid, received_roots, self._ingest_stream(received_nodes, received_roots, buffer))
+    
+    def _finish_swap(self, other_uuid, received_roots, new_roots):
+        self._set_replica_roots(other_uuid, received_roots)
+        self.roots = tuple(sorted(new_roots))
+        if self.storage is not None:
+            self.storage.append_roots(self.roots)
         self.update_stability()
 
-    def update_stability(self):
+    @timed("swap_final_many")
+    def swap_final_many(self, responses):
+        ## responses: { other_uuid : (received_nodes, received_roots) } from one round of respond_to_swap calls
+        ## peers mostly send overlapping deltas; each distinct new node is hashed once and later copies are compared
+        for other_uuid in responses:
+            self._check_member(other_uuid)
+        verified = {}
+        for other_uuid, (received_nodes, received_roots) in responses.items():
+            if self.metrics is not None:
+                self.metrics.observe("delta_nodes_received", len(received_nodes))
+            for hash, node in received_nodes.items():
+                first = verified.get(hash)
+                if first is None:
+                    verified[hash] = node
+                elif first.dependencies != node.dependencies or first.value != node.value:
+                    raise BadDelta(hash)
+        self._verify_delta(verified)
+
+        for other_uuid, (received_nodes, received_roots) in responses.items():
+            self._set_replica_roots(other_uuid, received_roots)
+            self.roots = tuple(sorted(self._determine_new_roots(received_nodes, received_roots)))
+        if self.storage is not None:
+            self.storage.append_roots(self.roots)
+        self.update_stability()
+
+    def _hold_roots(self, roots):
+        ## the interned frontier for roots, counted once more against it and against each root hash
+        refs, frontiers = self._root_refs, self._frontiers
+        roots = frozenset(roots)
+        if roots in frontiers:
+            roots = frontiers[roots][0]
+            frontiers[roots][1] += 1
+        else:
+            frontiers[roots] = [roots, 1]
+        for root in roots:
+            refs[root] = refs.get(root, 0) + 1
+        return roots
+    
+    def _release_roots(self, roots):
+        refs, frontiers = self._root_refs, self._frontiers
+        for root in roots:
+            refs[root] -= 1
+            if not refs[root]:
+                del refs[root]
+                self._delete_candidates.add(root)
+        frontiers[roots][1] -= 1
+        if not frontiers[roots][1]:
+            del frontiers[roots]
+    
+    def _set_replica_roots(self, uuid, roots):
+        self._release_roots(self.other_replica_roots[uuid])
+        roots = self._hold_roots(roots)
+        self.other_replica_roots[uuid] = roots
+        if self.incremental_stability:
+            self._dirty_replicas[uuid] = roots
+        if self.storage is not None:
+            self.storage.append_replica_roots(uuid, roots)
+    
+    def add_replica(self, uuid, roots = None):
+        ## a new peer, known to hold `roots` (e.g. ours when it was bootstrapped from our export_snapshot) or
+        ## nothing but genesis. Nodes already stable stay stable; unstable ones now also wait for it
+        if uuid == self.my_uuid or uuid in self.other_replica_roots:
+            raise ValueError("%r is already a replica of this log" % (uuid,))
+        if self.storage is not None:
+            self.storage.append_membership(uuid, True)
+        self._admit_replica(uuid)
+        if roots is not None:
+            self._set_replica_roots(uuid, set(roots))
+            self.update_stability()
+    
+    def _admit_replica(self, uuid):
+        bit = 1
+        while bit in self._bit_replicas:
+            bit <<= 1
+        self.other_replicas.append(uuid)
+        self._replica_bits[uuid] = bit
+        self._bit_replicas[bit] = uuid
+        self._all_replicas_mask |= bit
+        self.other_replica_roots[uuid] = self._hold_roots([self._get_genesis_node_hash()])
+        if self.incremental_stability and not self.large_cluster:
+            self._pending_send[uuid] = set(self._seen_by)
+    
+    def remove_replica(self, uuid):
+        ## evicts a peer for good: nodes that were only waiting on it become stable now and, with compaction
+        ## on, the whole stable prefix is compacted at once rather than a cog per swap
+        self._check_member(uuid)
+        if self.storage is not None:
+            self.storage.append_membership(uuid, False)
+        self._evict_replica(uuid)
+        self.update_stability()
+        if self.auto_compaction:
+            prefix = self.stable_prefix()
+            if prefix:
+                self.compact_log(prefix)
+    
+    def _check_member(self, uuid):
+        ## swaps with a peer that was removed (or never added) are refused before anything is merged
+        if uuid not in self.other_replica_roots:
+            raise ValueError("%r is not a replica of this log" % (uuid,))
+    
+    def _evict_replica(self, uuid):
+        self._release_roots(self.other_replica_roots.pop(uuid))
+        self.other_replicas = [r for r in self.other_replicas if r != uuid]
+        self._dirty_replicas.pop(uuid, None)
+        self._pending_send.pop(uuid, None)
+        bit = self._replica_bits.pop(uuid)
+        del self._bit_replicas[bit]
+        self._all_replicas_mask &= ~bit
+        if self.incremental_stability:
+            ## the bit is cleared everywhere so a later add_replica can reuse it
+            seen_by = self._seen_by
+            unstable_seen_everywhere = []
+            for hash, mask in seen_by.items():
+                mask &= ~bit
+                seen_by[hash] = mask
+                if mask == self._all_replicas_mask:
+                    unstable_seen_everywhere.append(hash)
+            for hash in unstable_seen_everywhere:
+                self.nodes[hash].mark_stable()
+                del seen_by[hash]
+            if self.metrics is not None:
+                self.metrics.inc("nodes_marked_stable", len(unstable_seen_everywhere))
+    
+    def _propagate_seen(self, bits, roots):
+        ## marks the ancestors of roots as held by every replica in bits. Replica views only grow, so every
+        ## ancestor of a node already marked for a replica is marked too: only the bits still missing go on
+        seen_by, pending_send, bit_replicas = self._seen_by, self._pending_send, self._bit_replicas
+        newly_seen_everywhere = []
+        if not bits & (bits - 1):
+            ## a single replica, as after one swap: the missing bits are the same all the way down
+            pending = pending_send.get(bit_replicas[bits])
+            stack = list(roots)
+            while stack:
+                n = stack.pop()
+                mask = seen_by.get(n)
+                if mask is None or mask & bits:
+                    continue
+                mask |= bits
+                seen_by[n] = mask
+                if pending is not None:
+                    pending.discard(n)
+                if mask == self._all_replicas_mask:
+                    newly_seen_everywhere.append(n)
+                stack.extend(self.dependencies[n])
+            return newly_seen_everywhere
+        stack = [(root, bits) for root in roots]
+        while stack:
+            n, bits = stack.pop()
+            mask = seen_by.get(n)
+            if mask is None or not bits & ~mask:
+                continue
+            bits &= ~mask
+            mask |= bits
+            seen_by[n] = mask
+            if pending_send:
+                rest = bits
+                while rest:
+                    bit = rest & -rest
+                    pending_send[bit_replicas[bit]].discard(n)
+                    rest ^= bit
+            if mask == self._all_replicas_mask:
+                newly_seen_everywhere.append(n)
+            stack.extend((d, bits) for d in self.dependencies[n])
+        return newly_seen_everywhere
+    
+    def _update_stability_incremental(self):
+        dirty, self._dirty_replicas = self._dirty_replicas, {}
+        
+        if not self._all_replicas_mask:
+            unstable_seen_everywhere = list(self._seen_by)
+        else:
+            ## replicas that moved to the same roots are propagated together
+            groups = {}
+            for uuid, roots in dirty.items():
+                groups[roots] = groups.get(roots, 0) | self._replica_bits[uuid]
+            unstable_seen_everywhere = []
+            for roots, bits in groups.items():
+                unstable_seen_everywhere.extend(self._propagate_seen(bits, roots))
+        
+        for hash in unstable_seen_everywhere:
+            self.nodes[hash].mark_stable()
+            del self._seen_by[hash]
+        if self.metrics is not None:
+            self.metrics.inc("nodes_marked_stable", len(unstable_seen_everywhere))
+    
+    def _update_stability_vectorized(self):
+        unstable_seen_everywhere = self._vectorized.update(list(self._frontiers))
+        for hash in unstable_seen_everywhere:
+            self.nodes[hash].mark_stable()
+        if self.metrics is not None:
+            self.metrics.inc("nodes_marked_stable", len(unstable_seen_everywhere))
+    
+    def _update_stability_full(self):
+        if self._vectorized is not None:
+            return self._update_stability_vectorized()
        
         unstable_seen_everywhere = self._bfs_from_roots_until(lambda x : not self.check_stable(x))
        
-        for replica in self.other_replicas:
-        
-            other_replica_roots = self.other_replica_roots[replica]
+        ## one walk per distinct frontier, however many replicas share it
+        for other_replica_roots in list(self._frontiers):
             seen_non_stable = self._bfs_from_nodes_until(other_replica_roots, lambda x :not self.check_stable(x))
             unstable_seen_everywhere = unstable_seen_everywhere.intersection(seen_non_stable)
 
+        marked = 0
         for hash in unstable_seen_everywhere:
             if hash in self.nodes:
                 self.nodes[hash].mark_stable()
-        
+                marked += 1
+        if self.metrics is not None:
+            self.metrics.inc("nodes_marked_stable", marked)
+    
+    @timed("update_stability")
+    def update_stability(self):
+        if self.incremental_stability:
+            self._update_stability_incremental()
+        else:
+            self._update_stability_full()
         
         if self.auto_compaction:
-            cog = self.next_cog()
+            cog = self._next_compaction()
             if cog:
                 self.compact_log(cog)
     
+    def happens_before(self, a, b):
+        ## a is a strict ancestor of b; both must be held
+        return a != b and self._reaches(a, b)
+    
+    def covered_by(self, hash, roots):
+        ## hash is one of roots or an ancestor of one, e.g. covered_by(x, log.other_replica_roots[uuid])
+        return any(self._reaches(hash, root) for root in roots)
+    
+    def in_view(self, hash, uuid):
+        return self.covered_by(hash, self.roots if uuid == self.my_uuid else self.other_replica_roots[uuid])
+    
+    def _reaches(self, a, b):
+        index = self.reachability
+        if index is not None and a in index:
+            ## a compacted b only has compacted ancestors
+            return b in index and index.reaches(a, b)
+        queue = deque([b])
+        seen = set()
+        while queue:
+            n = queue.pop()
+            if n == a:
+                return True
+            if n not in seen:
+                seen.add(n)
+                queue.extend(self.dependencies.get(n, ()))
+        return False
+    
     def is_deleted(self, hash):
         return hash not in self.compacted and hash not in self.dependents and hash not in self.dependencies
 
@@ -191,6 +785,9 @@ class MerkleLog:
         return all([ self.is_compacted(d) for d in self.dependencies[node] ])
     
     def get_compact_frontier(self):
+        return self._compact_frontier
+    
+    def _scan_compact_frontier(self):
         compacted_frontier = set()
         for hash in self.compacted:
             if hash in self.dependents:
@@ -202,6 +799,7 @@ class MerkleLog:
     def sole_dependents(self, node_hash):
         return [] if node_hash not in self.dependents else [d for d in self.dependents[node_hash] if self.solely_dependent(d, [node_hash])]
     
+    @timed("next_cog")
     def next_cog(self):
         
         queue = deque(self.get_compact_frontier()) 
@@ -217,42 +815,240 @@ class MerkleLog:
             
         return next_cog
     
+    def compact_step(self, budget):
+        ## compacts at most `budget` nodes, for callers that spread compaction out instead of running it in
+        ## update_stability (compaction.CompactionScheduler). A cog, or the stable prefix with bulk_compaction,
+        ## is taken ancestors first, so what is compacted is a prefix of the DAG after every step, and finished
+        ## by later steps whatever arrives in between. Returns the number of nodes compacted; 0 when none is ready
+        starts_cog = not self._cog_backlog
+        if starts_cog:
+            cog = self._next_compaction()
+            if not cog:
+                return 0
+            self._cog_backlog.extend(dependency_order({ hash : self.nodes[hash] for hash in cog }))
+        backlog = self._cog_backlog
+        part = [backlog.popleft() for _ in range(min(budget, len(backlog)))]
+        self.compact_log(part, starts_cog)
+        return len(part)
+    
+    @timed("stable_prefix")
+    def stable_prefix(self):
+        ## every live node that is stable and whose dependencies are compacted or in the result, found in one
+        ## walk up from the compact frontier: the most that can be compacted now. Unlike next_cog it goes past
+        ## nodes with several dependencies and doesn't give up at the first unstable node
+        prefix = set()
+        stack = [n for n in self._compact_frontier if self.check_stable(n)]
+        while stack:
+            n = stack.pop()
+            if n in prefix:
+                continue
+            prefix.add(n)
+            for dependent in self.dependents.get(n, ()):
+                if dependent not in prefix and self.check_stable(dependent) and all(d in prefix or self.is_compacted(d) for d in self.dependencies[dependent]):
+                    stack.append(dependent)
+        return prefix
+    
+    def _next_compaction(self):
+        return self.stable_prefix() if self.bulk_compaction else self.next_cog()
+    
     def can_delete(self, hash):
-        for key, value in self.other_replica_roots.items():
-            if hash in value:
-                return False 
-        return hash in self.dependents and self.dependents[hash] == []
-    
-    def compact_log(self, next_cog):
-        
-        for c in list(self.compacted):
-            if self.can_delete(c):
-                self.compacted.remove(c)
-                self.dependents.pop(c)
-                self.dependencies.pop(c)
-                
+        return hash not in self._root_refs and hash in self.dependents and not self.dependents[hash]
+    
+    def _delete_compacted(self, hash):
+        self.compacted.remove(hash)
+        self.dependents.pop(hash)
+        self.dependencies.pop(hash)
+        if self.storage is not None:
+            self.storage.node_deleted(hash)
+        if self.metrics is not None:
+            self.metrics.inc("nodes_deleted")
+    
+    @timed("compact_log")
+    def compact_log(self, next_cog, starts_cog = True):
+        ## starts_cog=False: next_cog continues a cog compact_step began, which total_compacted counted already
+        if self.storage is not None:
+            self.storage.append_compaction(next_cog, starts_cog)
+        
+        ## a compacted hash that isn't a candidate still has dependents or is a replica's root; it becomes
+        ## one again when its last dependent is compacted (below) or it leaves the roots (_set_replica_roots)
+        candidates, self._delete_candidates = self._delete_candidates, set()
+        for c in candidates:
+            if c in self.compacted:
+                if self.can_delete(c):
+                    self._delete_compacted(c)
 
-                assert(self.is_deleted(c) == True)
-            else:
-                assert(self.is_deleted(c) == False)
+                    assert(self.is_deleted(c) == True)
+                else:
+                    assert(self.is_deleted(c) == False)
         
-        self.total_compacted += 1
+        if starts_cog:
+            self.total_compacted += 1
         
+        emptied = []
         for n in next_cog:
             
             for d in self.dependencies[n]:
-                self.dependents[d].remove(n)
+                del self.dependents[d][n]
                 
                 if d in self.dependents and not self.dependents[d]:
-                    if self.can_delete(d):
-                        self.dependents.pop(d)
+                    emptied.append(d)
             
+            if self._vectorized is not None and not self.nodes[n].is_stable():
+                self._vectorized.discard(n)
             self.nodes.pop(n)
+            if self._seen_by.pop(n, None) is not None:
+                ## compacted before this log saw it become stable, as compactions replayed from storage are
+                for pending in self._pending_send.values():
+                    pending.discard(n)
+            if self.reachability is not None:
+                self.reachability.remove(n)
 
             self.compacted.add(n)
+            self._delete_candidates.add(n)
+        
+        ## deleted only once the whole cog is compacted, so no cog node loses its dependencies mid-loop
+        for d in emptied:
+            if d in self.compacted and self.can_delete(d):
+                self._delete_compacted(d)
+        if self.view is not None:
+            self.view.forget(next_cog)
+        
+        self._compact_frontier.difference_update(next_cog)
+        for n in next_cog:
+            if n in self.dependents:
+                for dependent in self.dependents[n]:
+                    if self.solely_dependent_on_compact(dependent):
+                        self._compact_frontier.add(dependent)
+        
+        if self.metrics is not None:
+            self.metrics.inc("nodes_compacted", len(next_cog))
+        if self.storage is not None:
+            self.storage.retire_segments()
         
     
                 
+    def _replay_node(self, node, local):
+        self._add_node_graph(node)
+        self._add_node_reverse_graph(node)
+        if self.view is not None:
+            self.view.insert(((h(node), node),))
+        if local:
+            self.roots = [h(node)]
+    
+    def _reindex(self):
+        ## segments written without the chain index need not hold dependencies before dependents, and replay
+        ## labels nodes in file order: label the live nodes again, ancestors first
+        if self.reachability is None:
+            return
+        genesis = self._get_genesis_node_hash()
+        live = { hash : node for hash, node in self.nodes.items() if hash != genesis }
+        self.reachability = ChainIndex()
+        order = dependency_order(live)
+        for hash in order:
+            self.reachability.add(hash, live[hash].dependencies)
+        if self._vectorized is not None:
+            from stability import VectorizedStability
+            self._vectorized = VectorizedStability(self.reachability)
+            for hash in order:
+                if not live[hash].is_stable():
+                    self._vectorized.add(hash)
+    
+    def _recover_stability(self):
+        ## replayed replica roots are already queued; compaction is left to the next update_stability
+        for hash in [hash for hash, dependents in self.dependents.items() if not dependents and not self._exists(hash)]:
+            ## reverse edges into nodes whose records were retired along with their segment
+            self.dependents.pop(hash)
+        self._compact_frontier = self._scan_compact_frontier()
+        self._delete_candidates.update(self.compacted)
+        if self.incremental_stability:
+            self._update_stability_incremental()
+        else:
+            self._update_stability_full()
+    
+    def _checkpoint(self):
+        genesis = self._get_genesis_node_hash()
+        replica_roots = tuple((uuid, tuple(roots)) for uuid, roots in self.other_replica_roots.items())
+        return tuple(self.roots), replica_roots, self.total_compacted, genesis in self.compacted, genesis in self.dependents
+    
+    def _apply_checkpoint(self, roots, replica_roots, total_compacted, genesis_compacted, genesis_has_dependents):
+        ## state carried by segments that were already retired, replica set included
+        self.roots = roots
+        members = set(uuid for uuid, _ in replica_roots)
+        for uuid in [uuid for uuid in self.other_replica_roots if uuid not in members]:
+            self._evict_replica(uuid)
+        for uuid, _ in replica_roots:
+            if uuid not in self.other_replica_roots:
+                self._admit_replica(uuid)
+        for uuid, other_roots in replica_roots:
+            self._set_replica_roots(uuid, set(other_roots))
+        self.total_compacted = total_compacted
+        genesis = self._get_genesis_node_hash()
+        if not genesis_compacted:
+            self.compacted.discard(genesis)
+            self.dependencies.pop(genesis, None)
+        elif genesis_has_dependents and genesis not in self.dependents:
+            self.dependents[genesis] = {}
+    
+    def export_snapshot(self):
+        ## live state only, so its size and load time don't grow with history: compacted hashes still held
+        ## (with their edges, values dropped), every live node in dependency order, and the roots we know of
+        compacted = tuple((hash, tuple(self.dependencies[hash]), hash in self.dependents) for hash in self.compacted)
+        nodes = tuple((hash, node.dependencies, node.value, node.is_stable()) for hash, node in self._iter_topological(tuple(self.roots), lambda x : x in self.nodes))
+        replica_roots = tuple((uuid, tuple(roots)) for uuid, roots in self.other_replica_roots.items()) + ((self.my_uuid, tuple(self.roots)),)
+        return encode_value((tuple(self.roots), replica_roots, self.total_compacted, compacted, nodes))
+    
+    @classmethod
+    def from_snapshot(cls, snapshot, my_uuid, other_replicas, **options):
+        ## bootstraps a new or far-behind replica; it continues with normal swaps afterwards
+        if options.get('storage') is not None:
+            raise ValueError("a snapshot is loaded into a fresh in-memory log")
+        try:
+            state, end = decode_value(snapshot, 0)
+        except (IndexError, struct.error) as e:
+            raise ValueError("truncated snapshot") from e
+        if end != len(snapshot):
+            raise ValueError("trailing bytes after snapshot")
+        if type(state) is not tuple or len(state) != 5:
+            raise ValueError("not a snapshot")
+        log = cls(my_uuid, other_replicas, **options)
+        log._load_snapshot(*state)
+        return log
+    
+    def _load_snapshot(self, roots, replica_roots, total_compacted, compacted, nodes):
+        ## a snapshot usually comes from a peer: its live nodes are checked like any delta (BadDelta) before
+        ## anything is loaded. Compacted hashes carry no value and are taken as given
+        genesis = self._get_genesis_node_hash()
+        received = { hash : self._make_node(dependencies, value, hash) for hash, dependencies, value, _ in nodes if hash != genesis }
+        self._verify_delta(received)
+        if genesis not in set(hash for hash, _, _ in compacted):
+            self.compacted.discard(genesis)
+            self.dependencies.pop(genesis, None)
+        
+        for hash, dependencies, has_dependents in compacted:
+            if hash != genesis:
+                self.compacted.add(hash)
+                self.dependencies[hash] = dependencies
+            if has_dependents and hash not in self.dependents:
+                self.dependents[hash] = {}
+        loaded = []
+        for hash, _, _, stable in nodes:
+            if hash != genesis:
+                node = received[hash]
+                if stable:
+                    node.mark_stable()
+                self._add_node_graph(node)
+                self._add_node_reverse_graph(node)
+                loaded.append((hash, node))
+        if self.view is not None:
+            self.view.insert(loaded)
+        
+        self.roots = roots
+        self.total_compacted = total_compacted
+        for uuid, other_roots in replica_roots:
+            if uuid in self.other_replica_roots:
+                self._set_replica_roots(uuid, set(other_roots))
+        self._recover_stability()
+    
     def __eq__(self, __o: object) -> bool:
         if not isinstance(__o, MerkleLog):
             return False 
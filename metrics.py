@@ -0,0 +1,131 @@
+import bisect
+import collections
+import functools
+import logging
+import time
+
+
+## MerkleLog(metrics=sink) reports to any object with inc(name, amount) and observe(name, value):
+##   counters    nodes_added, nodes_received, nodes_marked_stable, nodes_compacted, nodes_deleted
+##               swap_failures (counted by runtime.Replica for swaps that raised)
+##   histograms  bfs_nodes_visited, delta_nodes_sent, delta_nodes_received, <operation>_seconds
+## With metrics=None an instrumented call costs one attribute check.
+
+TIME_BUCKETS = tuple(10.0 ** (e / 2) for e in range(-12, 3))        # 1us .. 10s
+SIZE_BUCKETS = tuple(4 ** e for e in range(11))                      # 1 .. ~1M nodes
+
+
+def timed(operation):
+    ## records how long a MerkleLog method took as <operation>_seconds, if the log has a sink
+    name = operation + "_seconds"
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            sink = self.metrics
+            if sink is None:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                sink.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        ## upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+
+class MemorySink:
+    ## keeps every counter and histogram in process; timings use TIME_BUCKETS, everything else SIZE_BUCKETS
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = {}
+
+    def inc(self, name, amount = 1):
+        self.counters[name] += amount
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(TIME_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS)
+        histogram.observe(value)
+
+
+class PrometheusSink(MemorySink):
+    ## a MemorySink that renders the text exposition format, e.g. for an HTTP /metrics handler
+
+    def __init__(self, prefix = "merkle_log_", labels = None):
+        super().__init__()
+        self.prefix = prefix
+        self.labels = "".join('%s="%s",' % (key, value) for key, value in sorted((labels or {}).items()))
+
+    def render(self):
+        lines = []
+        braces = "{%s}" % self.labels[:-1] if self.labels else ""
+        for name, value in sorted(self.counters.items()):
+            metric = self.prefix + name + "_total"
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s%s %s" % (metric, braces, value))
+        for name, histogram in sorted(self.histograms.items()):
+            metric = self.prefix + name
+            lines.append("# TYPE %s histogram" % metric)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(float(bound))
+                lines.append('%s_bucket{%sle="%s"} %d' % (metric, self.labels, le, cumulative))
+            lines.append("%s_sum%s %r" % (metric, braces, histogram.sum))
+            lines.append("%s_count%s %d" % (metric, braces, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class LoggingSink:
+    ## logs every event at `level`; an operation slower than slow_seconds is logged as a warning together
+    ## with the traversals and deltas recorded while it ran, to tie a latency spike to what caused it
+
+    def __init__(self, logger = None, level = logging.DEBUG, slow_seconds = None, trail = 256):
+        self.logger = logger if logger is not None else logging.getLogger("merkle_log")
+        self.level = level
+        self.slow_seconds = slow_seconds
+        self._trail = collections.deque(maxlen=trail)
+
+    def inc(self, name, amount = 1):
+        self._record(name, amount)
+
+    def observe(self, name, value):
+        now = self._record(name, value)
+        if self.slow_seconds is not None and name.endswith("_seconds") and value >= self.slow_seconds:
+            during = ["%s=%s" % (event, amount) for at, event, amount in self._trail if at >= now - value and event != name]
+            self.logger.warning("slow %s: %.6fs (%s)", name[:-len("_seconds")], value, ", ".join(during))
+
+    def _record(self, name, value):
+        now = time.perf_counter()
+        if self.slow_seconds is not None:
+            self._trail.append((now, name, value))
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "%s %s", name, value)
+        return now
@@ -0,0 +1,213 @@
+import mmap
+import os
+import zlib
+
+from hashing import decode_value, decode_varint, encode_node, encode_value, encode_varint
+
+
+## record layout: kind | varint payload length | payload | crc32(kind + payload)
+_LOCAL_NODE = b'l'      # node appended by add_node; it becomes the only root
+_NODE = b'n'            # node received from a peer
+_ROOTS = b'r'
+_PEER_ROOTS = b'p'
+_COMPACT = b'c'
+_COMPACT_MORE = b'C'    # later slice of a cog that compact_step spread over several calls
+_CHECKPOINT = b'k'      # first record of every segment: state the older segments would otherwise carry
+_JOIN = b'j'            # replica added by add_replica; its roots follow as a peer roots record
+_EVICT = b'e'           # replica removed by remove_replica
+
+
+class SegmentLog:
+    ## Append-only persistence for a MerkleLog. Every mutation is written as a record; on startup the
+    ## segments are mmap'd and replayed through the log's own methods, which rebuilds the DAG,
+    ## compaction state and replica roots. A segment is deleted once it is the oldest one and every
+    ## node it holds has been deleted by compaction.
+    ## Durability: every record is handed to the OS as it is appended (the file is unbuffered), so a crash
+    ## of the process loses nothing. Losing power also loses what the OS has not written back yet:
+    ## fsync_every=N syncs after every N records and bounds that to N - 1 of them, at a cost in append
+    ## rate (benchmarks.py persistence). The default of 0 syncs only when a segment fills up and on close().
+
+    def __init__(self, directory, segment_bytes = 64 << 20, fsync_every = 0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        os.makedirs(directory, exist_ok=True)
+
+        self.log = None
+        self.index = {}                  # node hash -> (segment number, record offset)
+        self.live_nodes = {}             # segment number -> nodes in it not yet deleted
+        self._file = None
+        self._segment = None
+        self._size = 0
+        self._unsynced = 0
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "%012d.seg" % segment)
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    ## recovery
+
+    def attach(self, log):
+        segments = self.segments()
+        for i, segment in enumerate(segments):
+            self._replay_segment(log, segment, first = i == 0, last = i == len(segments) - 1)
+        log._reindex()
+        log._recover_stability()
+        ## replayed compactions ran without storage attached, so settle the live counts now
+        for hash in [hash for hash in self.index if not log._exists(hash)]:
+            self.node_deleted(hash)
+
+        self.log = log
+        self._open_segment(segments[-1] + 1 if segments else 0)
+
+    def _replay_segment(self, log, segment, first, last):
+        self.live_nodes[segment] = 0
+        with open(self._path(segment), 'r+b' if last else 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                buf = memoryview(mapped)
+                try:
+                    end = self._replay_records(log, segment, buf, first)
+                finally:
+                    buf.release()
+            if end is not None:
+                if not last:
+                    raise ValueError("corrupt record in segment %d at offset %d" % (segment, end))
+                ## torn write at the tail of the newest segment: drop it
+                f.truncate(end)
+
+    def _replay_records(self, log, segment, buf, first):
+        pos = 0
+        size = len(buf)
+        while pos < size:
+            start = pos
+            try:
+                kind = buf[pos]
+                length, pos = decode_varint(buf, pos + 1)
+                end = pos + length
+                if end + 4 > size or zlib.crc32(buf[pos:end], zlib.crc32(bytes([kind]))) != int.from_bytes(buf[end:end + 4], 'big'):
+                    return start
+            except IndexError:
+                return start
+            self._apply(log, segment, start, bytes([kind]), buf, pos, start == 0 and first)
+            pos = end + 4
+        return None
+
+    def _apply(self, log, segment, offset, kind, buf, pos, first_checkpoint):
+        if kind == _LOCAL_NODE or kind == _NODE:
+            digest, pos = decode_value(buf, pos)
+            count, pos = decode_varint(buf, pos)
+            dependencies = []
+            for _ in range(count):
+                dependency, pos = decode_value(buf, pos)
+                dependencies.append(dependency)
+            value, pos = decode_value(buf, pos)
+            log._replay_node(log._make_node(dependencies, value, digest), kind == _LOCAL_NODE)
+            self.index[digest] = (segment, offset)
+            self.live_nodes[segment] += 1
+        elif kind == _ROOTS:
+            log.roots = decode_value(buf, pos)[0]
+        elif kind == _PEER_ROOTS:
+            uuid, roots = decode_value(buf, pos)[0]
+            log._set_replica_roots(uuid, set(roots))
+        elif kind == _JOIN:
+            log._admit_replica(decode_value(buf, pos)[0])
+        elif kind == _EVICT:
+            log._evict_replica(decode_value(buf, pos)[0])
+        elif kind == _COMPACT or kind == _COMPACT_MORE:
+            ## cog nodes whose records sat in a retired segment were deleted by a later compaction
+            log.compact_log(set(n for n in decode_value(buf, pos)[0] if n in log.nodes), kind == _COMPACT)
+        elif kind == _CHECKPOINT and first_checkpoint:
+            log._apply_checkpoint(*decode_value(buf, pos)[0])
+
+    ## writing
+
+    def _open_segment(self, segment):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+        self._segment = segment
+        self._file = open(self._path(segment), 'ab', buffering=0)
+        self._size = 0
+        self.live_nodes.setdefault(segment, 0)
+        self._append(_CHECKPOINT, encode_value(self.log._checkpoint()))
+
+    def _append(self, kind, payload):
+        crc = zlib.crc32(payload, zlib.crc32(kind))
+        record = kind + encode_varint(len(payload)) + payload + crc.to_bytes(4, 'big')
+        offset = self._size
+        self._file.write(record)
+        self._size += len(record)
+        self._unsynced += 1
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            self.sync()
+        return offset
+
+    def _maybe_roll(self):
+        if self._size >= self.segment_bytes:
+            self._open_segment(self._segment + 1)
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def append_node(self, hash, node, local):
+        self._maybe_roll()
+        payload = encode_value(hash) + encode_node(node.dependencies, node.value)
+        self.index[hash] = (self._segment, self._append(_LOCAL_NODE if local else _NODE, payload))
+        self.live_nodes[self._segment] += 1
+
+    def append_roots(self, roots):
+        self._append(_ROOTS, encode_value(tuple(roots)))
+
+    def append_replica_roots(self, uuid, roots):
+        self._append(_PEER_ROOTS, encode_value((uuid, tuple(roots))))
+
+    def append_membership(self, uuid, joined):
+        self._append(_JOIN if joined else _EVICT, encode_value(uuid))
+
+    def append_compaction(self, cog, starts_cog = True):
+        self._append(_COMPACT if starts_cog else _COMPACT_MORE, encode_value(tuple(cog)))
+
+    def node_deleted(self, hash):
+        location = self.index.pop(hash, None)
+        if location is not None:
+            self.live_nodes[location[0]] -= 1
+
+    def retire_segments(self):
+        retired = []
+        for segment in sorted(self.live_nodes):
+            if segment == self._segment or self.live_nodes[segment]:
+                break
+            del self.live_nodes[segment]
+            os.remove(self._path(segment))
+            retired.append(segment)
+        return retired
+
+    def read_node(self, hash):
+        ## random access to a node record through the index, e.g. for values of compacted nodes
+        segment, offset = self.index[hash]
+        with open(self._path(segment), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            buf = memoryview(mapped)
+            try:
+                length, pos = decode_varint(buf, offset + 1)
+                _, pos = decode_value(buf, pos)
+                count, pos = decode_varint(buf, pos)
+                dependencies = []
+                for _ in range(count):
+                    dependency, pos = decode_value(buf, pos)
+                    dependencies.append(dependency)
+                value, pos = decode_value(buf, pos)
+                return tuple(dependencies), value
+            finally:
+                buf.release()
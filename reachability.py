@@ -0,0 +1,89 @@
+class ChainIndex:
+    ## Chain decomposition of the live (uncompacted) DAG. A node extends a chain whose tail it descends from,
+    ## or starts a new one; it is labelled (chain, position) and keeps the highest position it reaches on
+    ## every chain, itself included. a is an ancestor of b iff b reaches a's position
+    ## on a's chain. Compaction only ever removes a prefix of the DAG, so live ancestors are reached through
+    ## live nodes alone and chains whose nodes are all compacted drop out of new labels.
+
+    def __init__(self):
+        self.label = {}          # hash -> (chain, position)
+        self.reach = {}          # hash -> { chain : highest position reachable on it }
+        self._tails = {}         # chain -> hash of its last node, while that node is indexed
+        self._live = {}          # chain -> indexed nodes on it
+        self._chains = 0
+
+    def __contains__(self, hash):
+        return hash in self.label
+
+    def __len__(self):
+        return len(self.label)
+
+    def add(self, hash, dependencies):
+        ## dependencies must be indexed first (or compacted)
+        live, tails = self._live, self._tails
+        reach = {}
+        for d in dependencies:
+            d_reach = self.reach.get(d)
+            if d_reach is not None:
+                for c, p in d_reach.items():
+                    if c in live and reach.get(c, -1) < p:
+                        reach[c] = p
+        ## extend any chain whose tail is an ancestor, not only a dependency's: the number of chains then
+        ## stays near the width of the live DAG instead of growing with every concurrent write
+        chain = None
+        for c, p in reach.items():
+            tail = tails.get(c)
+            if tail is not None and self.label[tail][1] == p:
+                chain, position = c, p + 1
+                break
+        if chain is None:
+            chain, position = self._chains, 0
+            self._chains += 1
+        reach[chain] = position
+        self.label[hash] = (chain, position)
+        self.reach[hash] = reach
+        tails[chain] = hash
+        live[chain] = live.get(chain, 0) + 1
+
+    def remove(self, hash):
+        chain, _ = self.label.pop(hash)
+        del self.reach[hash]
+        if self._tails.get(chain) == hash:
+            del self._tails[chain]
+        self._live[chain] -= 1
+        if not self._live[chain]:
+            del self._live[chain]
+
+    def reaches(self, a, b):
+        ## a is b or one of its ancestors
+        chain, position = self.label[a]
+        return self.reach[b].get(chain, -1) >= position
+
+    def chains(self):
+        return len(self._live)
+
+    def chain_ids(self):
+        ## chains are numbered from 0 and never reused; this is one more than the highest number so far
+        return self._chains
+
+
+def dependency_order(nodes):
+    ## hashes of a { hash : node } delta with every node after those of its dependencies that are in the delta
+    ordered = []
+    placed = set()
+    for root in nodes:
+        if root in placed:
+            continue
+        placed.add(root)
+        stack = [(root, iter(nodes[root].dependencies))]
+        while stack:
+            n, pending = stack[-1]
+            for d in pending:
+                if d in nodes and d not in placed:
+                    placed.add(d)
+                    stack.append((d, iter(nodes[d].dependencies)))
+                    break
+            else:
+                stack.pop()
+                ordered.append(n)
+    return ordered
@@ -0,0 +1,62 @@
+import hashlib
+import math
+import struct
+
+from hashing import decode_varint, encode_value, encode_varint
+
+
+class BloomFilter:
+    ## Set membership over node digests, shipped by a replica so a peer can skip nodes it already holds.
+    ## Content digests are uniform already, so probe positions come straight from their bytes
+    ## (double hashing); other hash types, and any non-zero seed, go through blake2b first so a
+    ## retry with a new seed gets independent false positives.
+
+    def __init__(self, bits, hashes, data = None, seed = 0):
+        self.bits = bits
+        self.hashes = hashes
+        self.seed = seed
+        self.data = bytearray((bits + 7) // 8) if data is None else bytearray(data)
+
+    @classmethod
+    def of(cls, items, false_positive_rate = 0.01, seed = 0):
+        items = list(items)
+        n = max(len(items), 1)
+        bits = max(64, int(math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2)))
+        hashes = max(1, int(round(bits / n * math.log(2))))
+        bloom = cls(bits, hashes, seed=seed)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item):
+        if self.seed or type(item) is not bytes or len(item) < 16:
+            item = hashlib.blake2b(encode_value(item), digest_size=16, salt=self.seed.to_bytes(16, 'big')).digest()
+        h1, h2 = struct.unpack_from('<QQ', item)
+        h2 |= 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def add(self, item):
+        data = self.data
+        for p in self._positions(item):
+            data[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item):
+        data = self.data
+        for p in self._positions(item):
+            if not data[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return encode_varint(self.bits) + encode_varint(self.hashes) + encode_varint(self.seed) + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        bits, pos = decode_varint(buf, 0)
+        hashes, pos = decode_varint(buf, pos)
+        seed, pos = decode_varint(buf, pos)
+        data = buf[pos:]
+        if len(data) != (bits + 7) // 8:
+            raise ValueError("bloom filter payload has %d bytes, expected %d" % (len(data), (bits + 7) // 8))
+        return cls(bits, hashes, data, seed)
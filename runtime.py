@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import random
+import struct
+
+from codec import decode_delta, encode_delta
+from hashing import decode_value, encode_value
+
+
+## one swap between an initiator A and a responder B, over one connection:
+##   A -> B  swap   (A's delta and roots, from prepare_swap)
+##   B -> A  reply  (B's delta and new roots, from respond_to_swap)
+##   A -> B  ack    (A has applied the reply with swap_final; B runs on_deliver)
+SWAP = b's'
+REPLY = b'r'
+ACK = b'a'
+
+_FRAME_HEADER = struct.Struct('>I')
+
+_logger = logging.getLogger("merkle_log")
+
+
+class Replica:
+    ## Owns a MerkleLog and runs the swap protocol over a transport. Every log mutation runs on the
+    ## event loop between awaits, so add_node never waits on a swap in flight; swaps with different
+    ## peers are pipelined, swaps with the same peer share one connection and run one at a time.
+
+    def __init__(self, log, transport, max_in_flight = 64, compactor = None):
+        self.log = log
+        self.transport = transport
+        ## a compaction.CompactionScheduler over log, run while the replica is started
+        self.compactor = compactor
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._connections = {}
+        self._peer_locks = {}
+        self._serving = set()
+
+    @property
+    def uuid(self):
+        return self.log.my_uuid
+
+    async def start(self):
+        await self.transport.listen(self.uuid, self._serve)
+        if self.compactor is not None:
+            self.compactor.start()
+
+    async def close(self):
+        if self.compactor is not None:
+            await self.compactor.stop()
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
+        for task in list(self._serving):
+            task.cancel()
+        await self.transport.stop(self.uuid)
+
+    def add_node(self, value):
+        return self.log.add_node(value)
+
+    async def swap(self, peer_uuid):
+        async with self._in_flight:
+            lock = self._peer_locks.setdefault(peer_uuid, asyncio.Lock())
+            async with lock:
+                connection = self._connections.get(peer_uuid)
+                if connection is None:
+                    connection = self._connections[peer_uuid] = await self.transport.connect(peer_uuid)
+                try:
+                    await self._initiate(connection, peer_uuid)
+                except BaseException:
+                    ## the connection is in an unknown protocol state; the next swap reconnects
+                    del self._connections[peer_uuid]
+                    connection.close()
+                    raise
+
+    async def _initiate(self, connection, peer_uuid):
+        nodes, roots = self.log.prepare_swap(peer_uuid)
+        await connection.send((SWAP, self.uuid, nodes, roots))
+        kind, _, nodes, roots = await connection.recv()
+        if kind != REPLY:
+            raise ConnectionError("expected a swap reply, got %r" % kind)
+        self.log.swap_final(peer_uuid, nodes, roots)
+        await connection.send((ACK, self.uuid, None, None))
+
+    async def gossip(self, peer_uuids = None):
+        ## one round against every peer concurrently; returns the peers whose swap failed
+        peer_uuids = self.log.other_replicas if peer_uuids is None else peer_uuids
+        results = await asyncio.gather(*(self.swap(uuid) for uuid in peer_uuids), return_exceptions=True)
+        return { uuid : result for uuid, result in zip(peer_uuids, results) if isinstance(result, BaseException) }
+
+    async def gossip_forever(self, interval, rng = random):
+        ## a failed swap is reported and the next round picks a peer again; only cancellation stops the loop
+        while True:
+            await asyncio.sleep(interval)
+            if not self.log.other_replicas:
+                continue
+            peer_uuid = rng.choice(self.log.other_replicas)
+            try:
+                await self.swap(peer_uuid)
+            except Exception as error:
+                self._swap_failed(peer_uuid, error)
+
+    def _swap_failed(self, peer_uuid, error):
+        if self.log.metrics is not None:
+            self.log.metrics.inc("swap_failures", 1)
+        _logger.warning("replica %r: swap with %r failed: %r", self.uuid, peer_uuid, error, exc_info=error)
+
+    async def _serve(self, connection):
+        task = asyncio.current_task()
+        self._serving.add(task)
+        peer_uuid = None
+        try:
+            while True:
+                kind, peer_uuid, nodes, roots = await connection.recv()
+                if kind != SWAP:
+                    raise ConnectionError("expected a swap, got %r" % kind)
+                nodes, roots, on_deliver = self.log.respond_to_swap(peer_uuid, nodes, roots)
+                await connection.send((REPLY, self.uuid, nodes, roots))
+                kind, _, _, _ = await connection.recv()
+                if kind != ACK:
+                    raise ConnectionError("expected an ack, got %r" % kind)
+                on_deliver()
+        except asyncio.CancelledError:
+            ## close() stopped us
+            pass
+        except (ConnectionError, EOFError) as error:
+            ## the peer went away, which is how every connection ends; it reconnects on its next swap
+            _logger.debug("replica %r: connection from %r closed: %r", self.uuid, peer_uuid, error)
+        except Exception as error:
+            ## a delta we could not decode or verify, or a peer that is not a member; dropping the
+            ## connection fails the peer's swap
+            self._swap_failed(peer_uuid, error)
+        finally:
+            connection.close()
+            self._serving.discard(task)
+
+
+class _LocalConnection:
+    ## one end of an in-process duplex pipe; bounded queues give the same backpressure as a socket buffer
+
+    def __init__(self, incoming, outgoing):
+        self._incoming = incoming
+        self._outgoing = outgoing
+        self.closed = False
+
+    async def send(self, message):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        await self._outgoing.put(message)
+
+    async def recv(self):
+        message = await self._incoming.get()
+        if message is None:
+            raise ConnectionError("connection closed by peer")
+        return message
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self._outgoing.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+
+
+class LocalNetwork:
+    ## in-process transport shared by all replicas; messages are passed as objects, no encoding
+
+    def __init__(self, queue_size = 16):
+        self.queue_size = queue_size
+        self._handlers = {}
+
+    async def listen(self, uuid, handler):
+        self._handlers[uuid] = handler
+
+    async def stop(self, uuid):
+        self._handlers.pop(uuid, None)
+
+    async def connect(self, uuid):
+        handler = self._handlers.get(uuid)
+        if handler is None:
+            raise ConnectionError("replica %r is not listening" % (uuid,))
+        to_peer = asyncio.Queue(self.queue_size)
+        from_peer = asyncio.Queue(self.queue_size)
+        asyncio.get_running_loop().create_task(handler(_LocalConnection(to_peer, from_peer)))
+        return _LocalConnection(from_peer, to_peer)
+
+
+def encode_message(message):
+    kind, uuid, nodes, roots = message
+    payload = kind + encode_value(uuid)
+    if kind != ACK:
+        payload += encode_delta(nodes, roots)
+    return _FRAME_HEADER.pack(len(payload)) + payload
+
+
+def decode_message(payload):
+    kind = bytes(payload[:1])
+    uuid, pos = decode_value(payload, 1)
+    if kind == ACK:
+        return kind, uuid, None, None
+    nodes, roots = decode_delta(memoryview(payload)[pos:])
+    return kind, uuid, nodes, roots
+
+
+class _StreamConnection:
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    async def send(self, message):
+        self._writer.write(encode_message(message))
+        await self._writer.drain()
+
+    async def recv(self):
+        header = await self._reader.readexactly(_FRAME_HEADER.size)
+        return decode_message(await self._reader.readexactly(_FRAME_HEADER.unpack(header)[0]))
+
+    def close(self):
+        self._writer.close()
+
+
+class TcpTransport:
+    ## loopback or LAN transport using the binary delta format; addresses maps uuid -> (host, port),
+    ## and a port of 0 is replaced by the one the listening replica was given
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self._servers = {}
+
+    async def listen(self, uuid, handler):
+        async def on_connect(reader, writer):
+            await handler(_StreamConnection(reader, writer))
+
+        host, port = self.addresses[uuid]
+        server = await asyncio.start_server(on_connect, host, port)
+        self.addresses[uuid] = server.sockets[0].getsockname()[:2]
+        self._servers[uuid] = server
+
+    async def stop(self, uuid):
+        server = self._servers.pop(uuid, None)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+    async def connect(self, uuid):
+        reader, writer = await asyncio.open_connection(*self.addresses[uuid])
+        return _StreamConnection(reader, writer)
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class VectorizedStability:
+    ## Stability over the chain index (reachability.ChainIndex) with NumPy. Every unstable node is a row
+    ## holding its (chain, position) label; a replica holds a node iff one of its roots reaches that position
+    ## on that chain, so each replica costs one gather and one compare over all rows instead of a walk
+    ## of the unstable window. Rows are added unstable and leave once stable, or when their node is
+    ## compacted before this log saw it become stable (as compactions replayed from storage are).
+
+    def __init__(self, index, capacity = 1024):
+        self.index = index
+        self._hashes = np.empty(capacity, dtype=object)
+        self._chains = np.empty(capacity, dtype=np.int64)
+        self._positions = np.empty(capacity, dtype=np.int64)
+        self._count = 0
+        self._dropped = set()       # hashes whose rows leave on the next update
+
+    def __len__(self):
+        return self._count
+
+    def add(self, hash):
+        ## hash must be indexed already
+        row = self._count
+        if row == len(self._hashes):
+            self._grow(2 * row)
+        self._chains[row], self._positions[row] = self.index.label[hash]
+        self._hashes[row] = hash
+        self._count = row + 1
+
+    def discard(self, hash):
+        self._dropped.add(hash)
+
+    def _grow(self, capacity):
+        n = self._count
+        for name in ("_hashes", "_chains", "_positions"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+
+    def _reached(self, roots):
+        ## per chain, the highest position any of roots reaches; -1 where none does
+        reached = np.full(self.index.chain_ids(), -1, dtype=np.int64)
+        reach = self.index.reach
+        for root in roots:
+            ## compacted roots (and genesis) reach nothing that is still unstable
+            root_reach = reach.get(root)
+            if root_reach is not None:
+                chains = np.fromiter(root_reach.keys(), dtype=np.int64, count=len(root_reach))
+                positions = np.fromiter(root_reach.values(), dtype=np.int64, count=len(root_reach))
+                np.maximum.at(reached, chains, positions)
+        return reached
+
+    def update(self, replica_roots):
+        ## replica_roots: the roots of every other replica; returns the rows seen by all of them, which leave
+        if self._dropped:
+            self._keep(np.fromiter((hash not in self._dropped for hash in self._hashes[:self._count]), dtype=bool, count=self._count))
+            self._dropped = set()
+        n = self._count
+        if not n:
+            return []
+        chains, positions = self._chains[:n], self._positions[:n]
+        stable = np.ones(n, dtype=bool)
+        for roots in replica_roots:
+            stable &= positions <= self._reached(roots)[chains]
+            if not stable.any():
+                return []
+        newly_stable = self._hashes[:n][stable].tolist()
+        self._keep(~stable)
+        return newly_stable
+
+    def _keep(self, keep):
+        ## compacts the rows down to those where keep is set
+        n = self._count
+        left = int(keep.sum())
+        self._hashes[:left] = self._hashes[:n][keep]
+        self._chains[:left] = self._chains[:n][keep]
+        self._positions[:left] = self._positions[:n][keep]
+        self._hashes[left:n] = None
+        self._count = left
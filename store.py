@@ -0,0 +1,359 @@
+from array import array
+from collections.abc import Mapping
+
+
+## per-node flag bits, packed one byte per interned id
+_LIVE = 1       # has a nodes entry (not compacted)
+_DEPS = 2       # has a dependencies entry
+_KIDS = 4       # has a dependents entry
+_STABLE = 8
+
+_NO_CHILD = -1
+_MANY_CHILDREN = -2
+
+
+class CompactNodeStore:
+    ## Drop-in backing for MerkleLog.nodes / dependencies / dependents.
+    ## Hashes are interned to integer ids; dependencies live in one flat array (CSR style),
+    ## single children are stored inline and only fan-out nodes get an insertion-ordered dict.
+
+    def __init__(self):
+        self._ids = {}
+        self._hashes = []
+        self._values = []
+        self._flags = bytearray()
+        self._refs = array('l')
+
+        self._dep_start = array('q')
+        self._dep_len = array('l')
+        self._dep_ids = array('q')
+        self._dep_garbage = 0
+
+        self._first_child = array('q')
+        self._more_children = {}
+
+        self._free = []
+        self._counts = {_LIVE: 0, _DEPS: 0, _KIDS: 0}
+
+    def views(self):
+        return _NodesView(self), _DependenciesView(self), _DependentsView(self)
+
+    def _intern(self, hash):
+        id = self._ids.get(hash)
+        if id is not None:
+            return id
+        if self._free:
+            id = self._free.pop()
+            self._hashes[id] = hash
+            self._flags[id] = 0
+            self._refs[id] = 0
+            self._dep_start[id] = 0
+            self._dep_len[id] = 0
+            self._first_child[id] = _NO_CHILD
+        else:
+            id = len(self._hashes)
+            self._hashes.append(hash)
+            self._values.append(None)
+            self._flags.append(0)
+            self._refs.append(0)
+            self._dep_start.append(0)
+            self._dep_len.append(0)
+            self._first_child.append(_NO_CHILD)
+        self._ids[hash] = id
+        return id
+
+    def _release_if_unused(self, id):
+        if self._refs[id] == 0 and not self._flags[id] & (_LIVE | _DEPS | _KIDS):
+            del self._ids[self._hashes[id]]
+            self._hashes[id] = None
+            self._values[id] = None
+            self._free.append(id)
+
+    def _has(self, hash, flag):
+        id = self._ids.get(hash)
+        return id is not None and bool(self._flags[id] & flag)
+
+    def _set_flag(self, id, flag):
+        if not self._flags[id] & flag:
+            self._flags[id] |= flag
+            self._counts[flag] += 1
+
+    def _clear_flag(self, id, flag):
+        if self._flags[id] & flag:
+            self._flags[id] &= ~flag
+            self._counts[flag] -= 1
+
+    def _iter_flag(self, flag):
+        for id, hash in enumerate(self._hashes):
+            if self._flags[id] & flag:
+                yield hash
+
+    ## dependencies
+
+    def _dependency_ids(self, id):
+        start = self._dep_start[id]
+        return self._dep_ids[start:start + self._dep_len[id]]
+
+    def _dependencies(self, id):
+        hashes = self._hashes
+        deps = tuple(hashes[d] for d in self._dependency_ids(id))
+        ## genesis is recorded with an empty list, every other node has at least one dependency
+        return deps if deps else []
+
+    def _set_dependencies(self, id, dependencies):
+        if self._flags[id] & _DEPS:
+            ## MerkleLog sets a node's dependencies again right after the nodes entry wrote them
+            ids = self._ids
+            if self._dependency_ids(id).tolist() == [ids.get(d) for d in dependencies]:
+                return
+            self._drop_dependencies(id)
+        dep_ids = [self._intern(d) for d in dependencies]
+        for d in dep_ids:
+            self._refs[d] += 1
+        self._dep_start[id] = len(self._dep_ids)
+        self._dep_len[id] = len(dep_ids)
+        self._dep_ids.extend(dep_ids)
+        self._set_flag(id, _DEPS)
+
+    def _drop_dependencies(self, id):
+        dep_ids = self._dependency_ids(id)
+        self._dep_garbage += len(dep_ids)
+        self._dep_len[id] = 0
+        self._clear_flag(id, _DEPS)
+        for d in dep_ids:
+            self._refs[d] -= 1
+            self._release_if_unused(d)
+        if self._dep_garbage > 1024 and self._dep_garbage * 2 > len(self._dep_ids):
+            self._vacuum_dependencies()
+
+    def _vacuum_dependencies(self):
+        packed = array('q')
+        for id in range(len(self._hashes)):
+            if self._flags[id] & _DEPS:
+                start = self._dep_start[id]
+                self._dep_start[id] = len(packed)
+                packed.extend(self._dep_ids[start:start + self._dep_len[id]])
+        self._dep_ids = packed
+        self._dep_garbage = 0
+
+    ## dependents
+
+    def _child_ids(self, id):
+        first = self._first_child[id]
+        if first == _MANY_CHILDREN:
+            return self._more_children[id]
+        return () if first == _NO_CHILD else (first,)
+
+    def _add_child(self, id, child_hash):
+        child = self._intern(child_hash)
+        first = self._first_child[id]
+        if first == _MANY_CHILDREN:
+            children = self._more_children[id]
+            if child in children:
+                return
+            children[child] = None
+        elif first == _NO_CHILD:
+            self._first_child[id] = child
+        elif first == child:
+            return
+        else:
+            self._first_child[id] = _MANY_CHILDREN
+            self._more_children[id] = {first: None, child: None}
+        self._refs[child] += 1
+
+    def _remove_child(self, id, child_hash):
+        child = self._ids.get(child_hash)
+        first = self._first_child[id]
+        if first == _MANY_CHILDREN and child in self._more_children[id]:
+            children = self._more_children[id]
+            del children[child]
+            if len(children) == 1:
+                del self._more_children[id]
+                self._first_child[id] = next(iter(children))
+        elif child is not None and first == child:
+            self._first_child[id] = _NO_CHILD
+        else:
+            raise KeyError(child_hash)
+        self._refs[child] -= 1
+        self._release_if_unused(child)
+
+    def _drop_children(self, id):
+        child_ids = self._child_ids(id)
+        self._more_children.pop(id, None)
+        self._first_child[id] = _NO_CHILD
+        self._clear_flag(id, _KIDS)
+        for child in child_ids:
+            self._refs[child] -= 1
+            self._release_if_unused(child)
+
+
+class _CompactNode:
+    __slots__ = ('_store', '_id', '_hash', 'value')
+
+    def __init__(self, store, id, hash):
+        self._store = store
+        self._id = id
+        self._hash = hash
+        self.value = store._values[id]
+
+    def _checked_id(self):
+        ## a handle outlives its nodes entry: the id may have been recycled, or the node compacted while
+        ## something else still references the id
+        store = self._store
+        if store._hashes[self._id] != self._hash or not store._flags[self._id] & _LIVE:
+            raise KeyError(self._hash)
+        return self._id
+
+    @property
+    def dependencies(self):
+        return self._store._dependencies(self._checked_id())
+
+    @property
+    def digest(self):
+        return self._hash
+
+    def __hash__(self) -> int:
+        return hash(self._hash)
+
+    def is_stable(self):
+        return bool(self._store._flags[self._checked_id()] & _STABLE)
+
+    def mark_stable(self):
+        self._store._flags[self._checked_id()] |= _STABLE
+
+    def __repr__(self) -> str:
+        return str(self.value)
+
+
+class _ChildSet:
+    ## behaves like the {child: None} dict the plain store keeps per node
+    __slots__ = ('_store', '_id')
+
+    def __init__(self, store, id):
+        self._store = store
+        self._id = id
+
+    def _hashes(self):
+        hashes = self._store._hashes
+        return [hashes[c] for c in self._store._child_ids(self._id)]
+
+    def __len__(self):
+        first = self._store._first_child[self._id]
+        return len(self._store._more_children[self._id]) if first == _MANY_CHILDREN else int(first != _NO_CHILD)
+
+    def __iter__(self):
+        return iter(self._hashes())
+
+    def keys(self):
+        return self._hashes()
+
+    def __contains__(self, hash):
+        id = self._store._ids.get(hash)
+        return id is not None and (id in self._store._more_children[self._id] if self._store._first_child[self._id] == _MANY_CHILDREN else id == self._store._first_child[self._id])
+
+    def __setitem__(self, hash, value):
+        self._store._add_child(self._id, hash)
+
+    def __delitem__(self, hash):
+        self._store._remove_child(self._id, hash)
+
+    def __eq__(self, other):
+        return dict.fromkeys(self._hashes()) == (dict.fromkeys(other) if not isinstance(other, dict) else other)
+
+    def __repr__(self) -> str:
+        return repr(dict.fromkeys(self._hashes()))
+
+
+class _StoreView(Mapping):
+    _flag = None
+
+    def __init__(self, store):
+        self._store = store
+
+    def __contains__(self, hash):
+        return self._store._has(hash, self._flag)
+
+    def __iter__(self):
+        return self._store._iter_flag(self._flag)
+
+    def __len__(self):
+        return self._store._counts[self._flag]
+
+    def __getitem__(self, hash):
+        id = self._store._ids.get(hash)
+        if id is None or not self._store._flags[id] & self._flag:
+            raise KeyError(hash)
+        return self._get(id, hash)
+
+    def pop(self, hash, *default):
+        if hash not in self:
+            if default:
+                return default[0]
+            raise KeyError(hash)
+        id = self._store._ids[hash]
+        value = self._detached(id, hash)
+        self._drop(id)
+        self._store._release_if_unused(id)
+        return value
+
+    def _detached(self, id, hash):
+        return self._get(id, hash)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
+class _NodesView(_StoreView):
+    _flag = _LIVE
+
+    def _get(self, id, hash):
+        return _CompactNode(self._store, id, hash)
+
+    def __setitem__(self, hash, node):
+        store = self._store
+        id = store._intern(hash)
+        store._values[id] = node.value
+        if not store._flags[id] & _DEPS:
+            store._set_dependencies(id, node.dependencies)
+        if node.is_stable():
+            store._flags[id] |= _STABLE
+        store._set_flag(id, _LIVE)
+
+    def _drop(self, id):
+        self._store._values[id] = None
+        self._store._clear_flag(id, _LIVE)
+
+
+class _DependenciesView(_StoreView):
+    _flag = _DEPS
+
+    def _get(self, id, hash):
+        return self._store._dependencies(id)
+
+    def __setitem__(self, hash, dependencies):
+        self._store._set_dependencies(self._store._intern(hash), dependencies)
+
+    def _drop(self, id):
+        self._store._drop_dependencies(id)
+
+
+class _DependentsView(_StoreView):
+    _flag = _KIDS
+
+    def _get(self, id, hash):
+        return _ChildSet(self._store, id)
+
+    def _detached(self, id, hash):
+        return dict.fromkeys(self._get(id, hash))
+
+    def __setitem__(self, hash, dependents):
+        store = self._store
+        id = store._intern(hash)
+        if store._flags[id] & _KIDS:
+            store._drop_children(id)
+        store._set_flag(id, _KIDS)
+        for child in dependents:
+            store._add_child(id, child)
+
+    def _drop(self, id):
+        self._store._drop_children(id)
@@ -1,8 +1,21 @@
 import unittest
-from merkle import MerkleLog
+import asyncio
+import json
+import os
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from merkle import BadDelta, IncompleteDelta, MerkleLog
+from persist import SegmentLog
+from runtime import LocalNetwork, Replica, TcpTransport
+from benchmarks import simulate, swap_reconciled, swap_with_all_peers
+from reachability import dependency_order
+from reconcile import BloomFilter
+from metrics import LoggingSink, MemorySink, PrometheusSink
+from codec import decode_delta, encode_delta
+from compaction import CompactionScheduler
+from hashing import MAX_DEPTH, blake2b_hasher, builtin_hasher, decode_value, encode_value, sha256_hasher
 from visualize import visualize_merkel, visualize_multiple
-import numpy as np
-import matplotlib.pyplot as plt
 
 
 class MerkleLogTests(unittest.TestCase):
@@ -33,13 +46,13 @@ class MerkleLogTests(unittest.TestCase):
           
             self.assertEqual(log.dependencies, {genesis_node: [], node1_hash: (genesis_node, )})
 
-            self.assertEqual(log.dependents, {genesis_node: [node1_hash,]})
+            self.assertEqual(log.dependents, {genesis_node: {node1_hash: None}})
             self.assertEqual(log.roots, [node1_hash])
             
             node2_hash = log.add_node(20)
     
             self.assertEqual(log.dependencies, {genesis_node: [], node1_hash: (genesis_node,), node2_hash: (node1_hash,)})
-            self.assertEqual(log.dependents, {genesis_node: [node1_hash], node1_hash: [node2_hash]})
+            self.assertEqual(log.dependents, {genesis_node: {node1_hash: None}, node1_hash: {node2_hash: None}})
             self.assertEqual(log.roots, [node2_hash])
     
     def test_prepare_delta_basic(self):
@@ -175,20 +188,20 @@ class MerkleLogTests(unittest.TestCase):
                 log1_first_node: (genesis_node,),
                 log1_second_node: (log1_first_node,),
                 log1_third_node: (log1_second_node,),
-                log1_fourth_node: (log1_third_node, log2_second_node),
+                log1_fourth_node: tuple(sorted([log1_third_node, log2_second_node])),
                 log2_first_node: (genesis_node,),
                 log2_second_node: (log2_first_node,),
                 log1_fifth_node: (log1_fourth_node,)
             })
             
             self.assertEqual(log1.dependents, {
-                genesis_node: sorted([log1_first_node, log2_first_node]),
-                log1_first_node: [log1_second_node],
-                log1_second_node: [log1_third_node],
-                log1_third_node: [log1_fourth_node],
-                log2_first_node: [log2_second_node],
-                log2_second_node: [log1_fourth_node],
-                log1_fourth_node: [log1_fifth_node]
+                genesis_node: dict.fromkeys([log1_first_node, log2_first_node]),
+                log1_first_node: {log1_second_node: None},
+                log1_second_node: {log1_third_node: None},
+                log1_third_node: {log1_fourth_node: None},
+                log2_first_node: {log2_second_node: None},
+                log2_second_node: {log1_fourth_node: None},
+                log1_fourth_node: {log1_fifth_node: None}
             })
             
             ## Checking replica 2
@@ -198,15 +211,15 @@ class MerkleLogTests(unittest.TestCase):
                 log1_second_node: (log1_first_node,),
                 log2_first_node: (genesis_node,),
                 log2_second_node: (log2_first_node,),
-                log2_third_node: (log2_second_node, log1_second_node),
+                log2_third_node: tuple(sorted([log2_second_node, log1_second_node])),
             })
 
             self.assertEqual(log2.dependents, {
-                genesis_node: sorted([log2_first_node, log1_first_node ]),
-                log1_first_node: [log1_second_node],
-                log1_second_node: [log2_third_node],
-                log2_first_node: [log2_second_node],
-                log2_second_node: [log2_third_node],
+                genesis_node: dict.fromkeys([log2_first_node, log1_first_node]),
+                log1_first_node: {log1_second_node: None},
+                log1_second_node: {log2_third_node: None},
+                log2_first_node: {log2_second_node: None},
+                log2_second_node: {log2_third_node: None},
             })
         
     def test_stability_two(self):
@@ -843,6 +856,1152 @@ class MerkleLogTests(unittest.TestCase):
 
 
 
+    def test_incremental_stability_matches_full(self):
+        
+        uuids = [1, 2, 3, 4, 5]
+        rng = random.Random(7)
+        
+        incremental = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        full = [MerkleLog(uuid, uuids, enable_compaction=True, incremental_stability=False) for uuid in uuids]
+        
+        def stable_nodes(log):
+            return set(h for h, node in log.nodes.items() if node.is_stable())
+        
+        for t in range(300):
+            i = rng.randrange(5)
+            if rng.random() < 0.6:
+                value = incremental[i].my_uuid * 1000 + t
+                incremental[i].add_node(value)
+                full[i].add_node(value)
+            else:
+                j = rng.choice([j for j in range(5) if j != i])
+                self.swap_with_concurrent_ops(incremental[i], incremental[j])
+                self.swap_with_concurrent_ops(full[i], full[j])
+            
+            for a, b in zip(incremental, full):
+                self.assertEqual(stable_nodes(a), stable_nodes(b))
+                self.assertEqual(a.compacted, b.compacted)
+                self.assertEqual(a, b)
+
+
+    def test_compact_frontier_is_incremental(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(3)
+
+        for compact_store in (False, True):
+            logs = [MerkleLog(uuid, uuids, enable_compaction=True, compact_store=compact_store) for uuid in uuids]
+            for t in range(300):
+                i = rng.randrange(3)
+                if rng.random() < 0.5:
+                    logs[i].add_node(t)
+                else:
+                    j = rng.choice([j for j in range(3) if j != i])
+                    self.swap_with_concurrent_ops(logs[i], logs[j])
+
+                for log in logs:
+                    self.assertEqual(log.get_compact_frontier(), log._scan_compact_frontier())
+            self.assertGreater(logs[0].total_compacted, 0)
+
+
+    def test_batched_gossip_round(self):
+
+        uuids = [1, 2, 3, 4, 5]
+        rng = random.Random(13)
+
+        batched = [MerkleLog(uuid, uuids) for uuid in uuids]
+        single = [MerkleLog(uuid, uuids) for uuid in uuids]
+
+        for t in range(200):
+            i = rng.randrange(5)
+            if rng.random() < 0.5:
+                batched[i].add_node(t)
+                single[i].add_node(t)
+                continue
+
+            peers = [j for j in range(5) if j != i and rng.random() < 0.6]
+            deltas = batched[i].prepare_swap_many([batched[j].my_uuid for j in peers])
+            for j in peers:
+                self.assertEqual(deltas[batched[j].my_uuid], batched[i].prepare_swap(batched[j].my_uuid))
+
+            responses, deliveries = {}, []
+            for j in peers:
+                nodes, roots, on_deliver = batched[j].respond_to_swap(batched[i].my_uuid, *deltas[batched[j].my_uuid])
+                responses[batched[j].my_uuid] = (nodes, roots)
+                deliveries.append(on_deliver)
+            batched[i].swap_final_many(responses)
+            for on_deliver in deliveries:
+                on_deliver()
+
+            ## the same round done one peer at a time, each preparing from the state before the round
+            prepared = {j: single[i].prepare_swap(single[j].my_uuid) for j in peers}
+            responses = [(j, single[j].respond_to_swap(single[i].my_uuid, *prepared[j])) for j in peers]
+            for j, (nodes, roots, on_deliver) in responses:
+                single[i].swap_final(single[j].my_uuid, nodes, roots)
+            for j, (nodes, roots, on_deliver) in responses:
+                on_deliver()
+
+            for a, b in zip(batched, single):
+                self.assertEqual(a, b)
+                self.assertEqual(a.other_replica_roots, b.other_replica_roots)
+                self.assertEqual(set(h for h, n in a.nodes.items() if n.is_stable()), set(h for h, n in b.nodes.items() if n.is_stable()))
+
+
+    def test_replica_runtime(self):
+
+        uuids = [1, 2, 3]
+
+        async def run(make_transport):
+            transport = make_transport()
+            replicas = [Replica(MerkleLog(uuid, uuids, enable_compaction=True), transport) for uuid in uuids]
+            for replica in replicas:
+                await replica.start()
+
+            for t in range(30):
+                for replica in replicas:
+                    replica.add_node(replica.uuid * 1000 + t)
+                ## every replica gossips with both peers at once; writes keep landing while swaps are in flight
+                rounds = [asyncio.ensure_future(replica.gossip()) for replica in replicas]
+                replicas[t % 3].add_node(-t)
+                for failed in await asyncio.gather(*rounds):
+                    self.assertEqual(failed, {})
+
+            for _ in range(3):
+                for replica in replicas:
+                    self.assertEqual(await replica.gossip(), {})
+
+            logs = [replica.log for replica in replicas]
+            for replica in replicas:
+                await replica.close()
+            return logs
+
+        for make_transport in (LocalNetwork, lambda: TcpTransport({uuid: ("127.0.0.1", 0) for uuid in uuids})):
+            logs = asyncio.run(run(make_transport))
+            self.assertEqual(logs[0].roots, logs[1].roots)
+            self.assertEqual(logs[1].roots, logs[2].roots)
+            self.assertGreater(logs[0].total_compacted, 0)
+            ## every on_deliver ran, so each replica knows the others hold its roots
+            for log in logs:
+                for uuid in log.other_replicas:
+                    self.assertEqual(set(log.other_replica_roots[uuid]), set(log.roots))
+
+
+    def test_gossip_survives_failing_peers(self):
+
+        uuids = [1, 2, 3, 4]
+
+        async def run():
+            network = LocalNetwork()
+            sinks = [MemorySink() for _ in range(3)]
+            ## 4 never comes up, and 2 has removed 3, which keeps gossiping with it
+            replicas = [Replica(MerkleLog(uuid, uuids, metrics=sink), network) for uuid, sink in zip(uuids, sinks)]
+            replicas[1].log.remove_replica(3)
+            for replica in replicas:
+                await replica.start()
+                replica.add_node(replica.uuid)
+            tasks = [asyncio.ensure_future(replica.gossip_forever(0.001, random.Random(replica.uuid))) for replica in replicas]
+            with self.assertLogs("merkle_log", "WARNING"):
+                await asyncio.sleep(0.2)
+            self.assertFalse(any(task.done() for task in tasks))
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.assertEqual(await replicas[0].gossip([2]), {})
+            for replica in replicas:
+                await replica.close()
+            return [replica.log for replica in replicas], sinks
+
+        logs, sinks = asyncio.run(run())
+        self.assertEqual(logs[0].roots, logs[1].roots)
+        for sink in sinks:
+            self.assertGreater(sink.counters["swap_failures"], 0)
+
+    def stream_swap(self, log1, log2, buffer):
+        nodes_to_send, roots_to_send = log1.iter_swap(log2.my_uuid)
+        nodes_to_send2, roots_to_send2, on_deliver = log2.respond_to_swap_stream(log1.my_uuid, nodes_to_send, roots_to_send, buffer=buffer)
+        log1.swap_final_stream(log2.my_uuid, nodes_to_send2, roots_to_send2, buffer=buffer)
+        on_deliver()
+
+    def test_streaming_swap(self):
+
+        uuids = [1, 2, 3]
+        log1 = MerkleLog(1, uuids)
+        for t in range(20):
+            log1.add_node(t)
+        nodes, roots = log1.iter_swap(2)
+        order = [hash for hash, _ in nodes]
+        self.assertEqual(set(order), set(log1.prepare_swap(2)[0]))
+        position = { hash : i for i, hash in enumerate(order) }
+        for hash in order:
+            self.assertTrue(all(position.get(d, -1) < position[hash] for d in log1.dependencies[hash]))
+
+        ## dependents before their dependencies are rejected and the swap reports the gap
+        log2 = MerkleLog(2, uuids)
+        with self.assertRaises(IncompleteDelta):
+            log2.respond_to_swap_stream(1, reversed([(hash, log1.nodes[hash]) for hash in order]), roots, buffer=4)
+        self.assertEqual(set(log2.roots), {log2._get_genesis_node_hash()})
+
+        ## streamed swaps with a tiny buffer end in the same state as whole-delta swaps, compaction included
+        rng = random.Random(5)
+        plain = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        streamed = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        for t in range(300):
+            i = rng.randrange(3)
+            j = (i + 1 + rng.randrange(2)) % 3
+            if rng.random() < 0.5:
+                plain[i].add_node(t)
+                streamed[i].add_node(t)
+            else:
+                self.swap(plain[i], plain[j])
+                self.stream_swap(streamed[i], streamed[j], buffer=3)
+        for a, b in zip(plain, streamed):
+            self.assertEqual(a, b)
+            self.assertEqual(set(a.nodes), set(b.nodes))
+
+    def test_snapshot_bootstrap(self):
+
+        uuids = [1, 2, 3]
+        for compact_store in [False, True]:
+            rng = random.Random(3)
+            logs = [MerkleLog(uuid, uuids, enable_compaction=True, compact_store=compact_store) for uuid in uuids]
+            def run(steps, active):
+                for t in range(steps):
+                    i, j = rng.sample(active, 2)
+                    if rng.random() < 0.5:
+                        logs[i].add_node(t)
+                    else:
+                        self.swap(logs[i], logs[j])
+
+            ## replica 3 loses its state while the others keep compacting past what it knew
+            run(300, [0, 1, 2])
+            logs[2] = MerkleLog(3, uuids, enable_compaction=True, compact_store=compact_store)
+            run(200, [0, 1])
+            self.assertTrue(logs[0].total_compacted > 0)
+
+            snapshot = logs[0].export_snapshot()
+            logs[2] = MerkleLog.from_snapshot(snapshot, 3, uuids, enable_compaction=True, compact_store=compact_store)
+            source, loaded = logs[0], logs[2]
+            self.assertEqual(loaded.dependencies, source.dependencies)
+            self.assertEqual(loaded.dependents, source.dependents)
+            self.assertEqual(loaded.compacted, source.compacted)
+            self.assertEqual(set(loaded.nodes), set(source.nodes))
+            self.assertEqual(tuple(loaded.roots), tuple(source.roots))
+            self.assertEqual(loaded.get_compact_frontier(), source.get_compact_frontier())
+            self.assertEqual(set(loaded.other_replica_roots[1]), set(source.roots))
+
+            ## and takes part in normal swaps and compaction from there
+            total_compacted = loaded.total_compacted
+            run(300, [0, 1, 2])
+            for i, j in [(0, 1), (1, 2), (2, 0), (0, 1)]:
+                self.swap(logs[i], logs[j])
+            self.assertTrue(loaded.total_compacted > total_compacted)
+            self.assertEqual(set(logs[0].roots), set(logs[1].roots))
+            self.assertEqual(set(logs[1].roots), set(logs[2].roots))
+
+        ## a snapshot is checked like a delta: a forged value under its original hash, a cut-off buffer and
+        ## trailing bytes are all refused
+        snapshot = logs[0].export_snapshot()
+        roots, replica_roots, total_compacted, compacted, nodes = decode_value(snapshot, 0)[0]
+        forged = ((nodes[-1][0], nodes[-1][1], "forged", nodes[-1][3]),)
+        tampered = encode_value((roots, replica_roots, total_compacted, compacted, nodes[:-1] + forged))
+        with self.assertRaises(BadDelta) as raised:
+            MerkleLog.from_snapshot(tampered, 3, uuids)
+        self.assertEqual(raised.exception.hash, nodes[-1][0])
+        for broken in (snapshot[:-5], snapshot[:len(snapshot) // 2], snapshot + b"N"):
+            with self.assertRaises(ValueError):
+                MerkleLog.from_snapshot(broken, 3, uuids)
+
+    def test_metrics(self):
+
+        uuids = [1, 2]
+        sink = PrometheusSink(labels={"replica": 1})
+        log1 = MerkleLog(1, uuids, enable_compaction=True, metrics=sink)
+        log2 = MerkleLog(2, uuids, enable_compaction=True, metrics=MemorySink())
+        for t in range(10):
+            log1.add_node(t)
+            log2.add_node(-t - 1)
+            self.swap(log1, log2)
+
+        self.assertEqual(sink.counters["nodes_added"], 10)
+        self.assertEqual(sink.counters["nodes_received"], 10)
+        self.assertTrue(0 < sink.counters["nodes_compacted"] <= sink.counters["nodes_marked_stable"])
+        self.assertEqual(sink.histograms["prepare_swap_seconds"].count, 10)
+        self.assertEqual(sink.histograms["delta_nodes_sent"].sum, 10)
+        self.assertEqual(log2.metrics.histograms["delta_nodes_received"].sum, 10)
+
+        text = sink.render()
+        self.assertIn('merkle_log_nodes_added_total{replica="1"} 10\n', text)
+        self.assertIn('merkle_log_swap_final_seconds_bucket{replica="1",le="+Inf"} 10\n', text)
+        self.assertIn('merkle_log_swap_final_seconds_count{replica="1"} 10\n', text)
+
+        ## a slow operation is logged with what it traversed
+        log1.metrics = LoggingSink(slow_seconds=0)
+        log1.add_node(10)
+        with self.assertLogs("merkle_log", "WARNING") as logged:
+            log1.prepare_swap(2)
+        self.assertEqual(len(logged.records), 1)
+        self.assertIn("slow prepare_swap", logged.output[0])
+        self.assertIn("delta_nodes_sent=1", logged.output[0])
+
+    def test_pending_send(self):
+
+        uuids = [1, 2, 3, 4]
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        rng = random.Random(11)
+        for t in range(400):
+            i, j = rng.sample(range(4), 2)
+            if rng.random() < 0.5:
+                logs[i].add_node(t)
+            else:
+                self.swap(logs[i], logs[j])
+            if t % 40 == 0:
+                for log in logs:
+                    for peer in log.other_replicas:
+                        nodes, _ = log.prepare_swap(peer)
+                        other_roots = log.other_replica_roots[peer]
+                        walked = log._bfs_from_roots_until(lambda x : x not in other_roots and not log.check_stable(x))
+                        bit = log._replica_bits[peer]
+                        self.assertEqual(set(nodes), { hash for hash, mask in log._seen_by.items() if not mask & bit })
+                        self.assertTrue(set(nodes) <= walked)
+        self.assertTrue(logs[0].total_compacted > 0)
+
+    def test_add_nodes(self):
+
+        uuids = [1, 2, 3]
+        for compact_store in [False, True]:
+            rng = random.Random(8)
+            single = [MerkleLog(uuid, uuids, enable_compaction=True, compact_store=compact_store) for uuid in uuids]
+            bulk = [MerkleLog(uuid, uuids, enable_compaction=True, compact_store=compact_store) for uuid in uuids]
+            for t in range(200):
+                i, j = rng.sample(range(3), 2)
+                if rng.random() < 0.5:
+                    values = [(t, k) for k in range(rng.randrange(4))]
+                    self.assertEqual(bulk[i].add_nodes(values), [single[i].add_node(value) for value in values])
+                else:
+                    self.swap(single[i], single[j])
+                    self.swap(bulk[i], bulk[j])
+            for a, b in zip(single, bulk):
+                self.assertEqual(a, b)
+                self.assertEqual({h: (n.value, n.is_stable()) for h, n in a.nodes.items()}, {h: (n.value, n.is_stable()) for h, n in b.nodes.items()})
+                self.assertEqual(a.compacted, b.compacted)
+                self.assertEqual(a.get_compact_frontier(), b.get_compact_frontier())
+                self.assertEqual(a._seen_by, b._seen_by)
+                self.assertEqual(a._pending_send, b._pending_send)
+            self.assertTrue(bulk[0].total_compacted > 0)
+
+        for hasher in [sha256_hasher, builtin_hasher]:
+            a, b = MerkleLog(1, uuids, hasher=hasher), MerkleLog(1, uuids, hasher=hasher)
+            self.assertEqual(b.add_nodes(["x", 2, None]), [a.add_node(value) for value in ["x", 2, None]])
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = MerkleLog(1, uuids, storage=SegmentLog(directory))
+            log.add_nodes(range(10))
+            log.storage.close()
+            recovered = MerkleLog(1, uuids, storage=SegmentLog(directory))
+            self.assertEqual(recovered, log)
+            recovered.storage.close()
+
+    def test_reachability_index(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(13)
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True, reachability_index=True) for uuid in uuids]
+        for t in range(300):
+            i, j = rng.sample(range(3), 2)
+            if rng.random() < 0.4:
+                logs[i].add_nodes([(t, k) for k in range(rng.randrange(1, 4))])
+            else:
+                self.swap(logs[i], logs[j])
+            if t % 30 == 29:
+                for log in logs:
+                    self.assertEqual(set(log.reachability.label), set(log.nodes) - log.compacted - {log._get_genesis_node_hash()})
+                    held = list(log.dependencies)
+                    for a, b in [(rng.choice(held), rng.choice(held)) for _ in range(100)]:
+                        walked = a != b and a in log._bfs_from_nodes_until([b], lambda x : x in log.dependencies)
+                        self.assertEqual(log.happens_before(a, b), walked)
+                        self.assertFalse(log.happens_before(a, b) and log.happens_before(b, a))
+                    for uuid in uuids:
+                        roots = log.roots if uuid == log.my_uuid else log.other_replica_roots[uuid]
+                        for a in [rng.choice(held) for _ in range(20)]:
+                            walked = a in log._bfs_from_nodes_until(roots, lambda x : x in log.dependencies)
+                            self.assertEqual(log.in_view(a, uuid), walked)
+        self.assertTrue(logs[0].total_compacted > 0)
+
+    def test_vectorized_stability(self):
+
+        uuids = [1, 2, 3, 4]
+        rng = random.Random(19)
+        full = [MerkleLog(uuid, uuids, enable_compaction=True, incremental_stability=False) for uuid in uuids]
+        vectorized = [MerkleLog(uuid, uuids, enable_compaction=True, incremental_stability=False, vectorized_stability=True) for uuid in uuids]
+
+        def stable_nodes(log):
+            return set(h for h, node in log.nodes.items() if node.is_stable())
+
+        for t in range(300):
+            i = rng.randrange(4)
+            if rng.random() < 0.5:
+                values = [(t, k) for k in range(rng.randrange(1, 4))]
+                full[i].add_nodes(values)
+                vectorized[i].add_nodes(values)
+            else:
+                j = rng.choice([j for j in range(4) if j != i])
+                self.swap_with_concurrent_ops(full[i], full[j])
+                self.swap_with_concurrent_ops(vectorized[i], vectorized[j])
+
+            for a, b in zip(full, vectorized):
+                self.assertEqual(stable_nodes(a), stable_nodes(b))
+                self.assertEqual(a.compacted, b.compacted)
+                self.assertEqual(a, b)
+                self.assertEqual(len(b._vectorized), len(b.nodes) - len(stable_nodes(b)))
+        self.assertTrue(vectorized[0].total_compacted > 0)
+
+        copy = MerkleLog.from_snapshot(vectorized[0].export_snapshot(), 1, uuids, incremental_stability=False, vectorized_stability=True)
+        self.assertEqual(stable_nodes(copy), stable_nodes(vectorized[0]))
+        with self.assertRaises(ValueError):
+            MerkleLog(1, uuids, vectorized_stability=True)
+
+    def test_ordered_view(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(23)
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True, ordered_view=True) for uuid in uuids]
+        readers = [([], logs[i].view.cursor()) for i in range(3)]
+
+        def min_hash_order(nodes):
+            order, placed = [], set()
+            while len(order) < len(nodes):
+                hash = min(x for x in nodes if x not in placed and all(d in placed or d not in nodes for d in nodes[x].dependencies))
+                order.append(hash)
+                placed.add(hash)
+            return order
+
+        for t in range(240):
+            i, j = rng.sample(range(3), 2)
+            if rng.random() < 0.5:
+                logs[i].add_nodes([(t, k) for k in range(rng.randrange(1, 4))])
+            else:
+                self.swap_with_concurrent_ops(logs[i], logs[j])
+            for k, log in enumerate(logs):
+                applied, cursor = readers[k]
+                keep, entries, cursor = log.view.changes_since(cursor)
+                readers[k] = (applied[:keep] + entries, cursor)
+                self.assertEqual(len(readers[k][0]), len(log.view))
+                self.assertEqual(readers[k][0][log.view.offset:], list(log.view.entries()))
+            if t % 40 == 39:
+                for log in logs:
+                    self.assertEqual([hash for hash, _ in log.view.entries()], min_hash_order(log.view._nodes))
+                    ## compacted entries are dropped up to the first live one; every live node is still held
+                    self.assertLessEqual(set(log.nodes) - {log._get_genesis_node_hash()}, set(log.view._nodes))
+                    self.assertIn(log.view._order[0], log.nodes)
+        self.assertTrue(logs[0].total_compacted > 0)
+        self.assertGreater(logs[0].view.offset, 0)
+        self.assertLess(len(logs[0].view._nodes), len(readers[0][0]))
+        self.assertTrue(all(position >= logs[0].view.offset for _, position in logs[0].view._rewinds))
+        with self.assertRaises(ValueError):
+            logs[0].view.changes_since((0, 0))
+        with self.assertRaises(ValueError):
+            list(logs[0].view.entries(0))
+
+        for i, j in [(0, 1), (1, 2), (2, 0), (0, 1)]:
+            self.swap(logs[i], logs[j])
+        self.assertEqual(logs[0].roots, logs[1].roots)
+        for k, log in enumerate(logs):
+            applied, cursor = readers[k]
+            keep, entries, cursor = log.view.changes_since(cursor)
+            readers[k] = (applied[:keep] + entries, cursor)
+        self.assertEqual(readers[0][0], readers[1][0])
+        self.assertEqual(readers[1][0], readers[2][0])
+
+    def test_ordered_view_caught_up_cursor(self):
+
+        uuids = [1, 2]
+        log1, log2 = [MerkleLog(uuid, uuids, ordered_view=True) for uuid in uuids]
+        log1.add_nodes(range(5))
+        log2.add_nodes(range(5, 10))
+        self.swap(log1, log2)
+        ## a merge that re-sorted placed entries; a reader that read after it has nothing to redo
+        view = log1.view
+        self.assertTrue(view._rewinds)
+        cursor = view.cursor()
+        self.assertEqual(view.changes_since(cursor), (len(view), [], cursor))
+        log1.add_node(10)
+        keep, entries, _ = view.changes_since(cursor)
+        self.assertEqual((keep, [value for _, value in entries]), (len(view) - 1, [10]))
+
+    def test_compact_step_counts_cogs(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(31)
+        with tempfile.TemporaryDirectory() as directory:
+            sliced = [MerkleLog(1, uuids, storage=SegmentLog(directory))] + [MerkleLog(uuid, uuids) for uuid in uuids[1:]]
+            whole = [MerkleLog(uuid, uuids) for uuid in uuids]
+            for t in range(200):
+                i, j = rng.sample(range(3), 2)
+                for group in (sliced, whole):
+                    group[i].add_node(t)
+                    self.swap(group[i], group[j])
+
+            ## a cog compacted one node per step counts once, as it does when compacted in one go
+            cogs = 0
+            while whole[0].compact_step(10 ** 6):
+                cogs += 1
+            while sliced[0].compact_step(1):
+                pass
+            self.assertGreater(cogs, 0)
+            self.assertEqual(whole[0].total_compacted, cogs)
+            self.assertEqual(sliced[0].total_compacted, cogs)
+            self.assertEqual(sliced[0].compacted, whole[0].compacted)
+            sliced[0].storage.close()
+
+            recovered = MerkleLog(1, uuids, storage=SegmentLog(directory))
+            self.assertEqual(recovered.total_compacted, cogs)
+            recovered.storage.close()
+
+    def test_background_compaction(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(29)
+        inline = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        stepped = [MerkleLog(uuid, uuids) for uuid in uuids]
+        with self.assertRaises(ValueError):
+            CompactionScheduler(inline[0])
+        schedulers = [CompactionScheduler(log, budget=2) for log in stepped]
+
+        for t in range(300):
+            i, j = rng.sample(range(3), 2)
+            if rng.random() < 0.4:
+                inline[i].add_node(t)
+                stepped[i].add_node(t)
+            else:
+                self.swap_with_concurrent_ops(inline[i], inline[j])
+                self.swap_with_concurrent_ops(stepped[i], stepped[j])
+                schedulers[i].run_slice()
+            for log in stepped:
+                ## what is compacted stays a prefix of the DAG between slices
+                for hash in log.compacted:
+                    self.assertTrue(all(d in log.compacted or d not in log.dependencies for d in log.dependencies[hash]))
+        self.assertGreater(stepped[0].total_compacted, 0)
+
+        for a, b, scheduler in zip(inline, stepped, schedulers):
+            while scheduler.run_slice():
+                pass
+            while a.next_cog():
+                a.compact_log(a.next_cog())
+            self.assertEqual(a.roots, b.roots)
+            self.assertEqual(set(a.nodes), set(b.nodes))
+
+        async def run():
+            network = LocalNetwork()
+            replicas = []
+            for uuid in uuids:
+                log = MerkleLog(uuid, uuids)
+                replicas.append(Replica(log, network, compactor=CompactionScheduler(log, budget=4, idle_seconds=0)))
+            for replica in replicas:
+                await replica.start()
+            for t in range(40):
+                for replica in replicas:
+                    replica.add_node(replica.uuid * 1000 + t)
+                for failed in await asyncio.gather(*(replica.gossip() for replica in replicas)):
+                    self.assertEqual(failed, {})
+            logs = [replica.log for replica in replicas]
+            for replica in replicas:
+                await replica.close()
+            return logs
+
+        logs = asyncio.run(run())
+        self.assertEqual(logs[0].roots, logs[1].roots)
+        self.assertGreater(logs[0].total_compacted, 0)
+
+    def test_bulk_compaction(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(31)
+        cogs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        bulk = [MerkleLog(uuid, uuids, enable_compaction=True, bulk_compaction=True) for uuid in uuids]
+        genesis = bulk[0]._get_genesis_node_hash()
+
+        for t in range(600):
+            i = rng.randrange(3)
+            j = (i + 1 + rng.randrange(2)) % 3
+            cogs[i].add_node(t)
+            bulk[i].add_node(t)
+            ## replica 3 is cut off for the first half
+            if t < 300 and 2 in (i, j):
+                continue
+            self.swap_with_concurrent_ops(cogs[i], cogs[j])
+            self.swap_with_concurrent_ops(bulk[i], bulk[j])
+            self.assertEqual(cogs[i].roots, bulk[i].roots)
+            for log in (bulk[i], bulk[j]):
+                ## everything stable is compacted as soon as it is known to be
+                self.assertEqual([hash for hash, node in log.nodes.items() if node.is_stable() and hash != genesis], [])
+                self.assertEqual(log.stable_prefix(), set())
+                for hash in log.compacted:
+                    self.assertTrue(all(d in log.compacted or d not in log.dependencies for d in log.dependencies[hash]))
+            if t == 320:
+                self.assertLess(len(bulk[0].nodes), 50)
+                self.assertGreater(len(cogs[0].nodes), 200)
+
+    def test_root_refs(self):
+
+        uuids = [1, 2, 3, 4]
+        rng = random.Random(37)
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        for t in range(400):
+            i, j = rng.sample(range(4), 2)
+            logs[i].add_node(t)
+            self.swap_with_concurrent_ops(logs[i], logs[j])
+            for log in (logs[i], logs[j]):
+                refs = {}
+                for roots in log.other_replica_roots.values():
+                    for root in roots:
+                        refs[root] = refs.get(root, 0) + 1
+                self.assertEqual(log._root_refs, refs)
+                ## nothing deletable is left behind by checking candidates only
+                for hash in log.compacted:
+                    pinned = any(hash in roots for roots in log.other_replica_roots.values())
+                    self.assertEqual(log.can_delete(hash), not pinned and hash in log.dependents and not log.dependents[hash])
+                    self.assertTrue(not log.can_delete(hash) or hash in log._delete_candidates)
+        self.assertGreater(logs[0].total_compacted, 0)
+
+    def test_large_cluster(self):
+
+        uuids = list(range(1, 9))
+        rng = random.Random(41)
+        default = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        large = [MerkleLog(uuid, uuids, enable_compaction=True, large_cluster=True) for uuid in uuids]
+        self.assertEqual(large[0]._pending_send, {})
+
+        def stable_nodes(log):
+            return set(h for h, node in log.nodes.items() if node.is_stable())
+
+        for t in range(400):
+            i, j = rng.sample(range(8), 2)
+            r = rng.random()
+            if r < 0.45:
+                default[i].add_node(t)
+                large[i].add_node(t)
+            elif r < 0.55:
+                ## peers that respond with the same roots are propagated as one group
+                swap_with_all_peers(default[i], default[:i] + default[i + 1:])
+                swap_with_all_peers(large[i], large[:i] + large[i + 1:])
+            else:
+                self.assertEqual(set(default[i].prepare_swap(uuids[j])[0]), set(large[i].prepare_swap(uuids[j])[0]))
+                self.swap_with_concurrent_ops(default[i], default[j])
+                self.swap_with_concurrent_ops(large[i], large[j])
+            for a, b in zip(default, large):
+                self.assertEqual(stable_nodes(a), stable_nodes(b))
+                self.assertEqual(a, b)
+        self.assertGreater(large[0].total_compacted, 0)
+
+        ## once replica 1 holds everything and has swapped with everyone again, they share one frontier
+        for _ in range(2):
+            for log in large[1:]:
+                self.swap(large[0], log)
+        log = large[0]
+        self.assertEqual(len(log._frontiers), 1)
+        frontier = log.other_replica_roots[uuids[1]]
+        self.assertTrue(all(roots is frontier for roots in log.other_replica_roots.values()))
+        self.assertEqual(set(frontier), set(log.roots))
+
+    def test_dynamic_membership(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(43)
+
+        def stable_nodes(log):
+            return set(h for h, node in log.nodes.items() if node.is_stable())
+
+        with tempfile.TemporaryDirectory() as directory:
+            storage = SegmentLog(directory, segment_bytes=2048)
+            logs = [MerkleLog(1, uuids, enable_compaction=True, storage=storage)] + [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids[1:]]
+            full = [MerkleLog(uuid, uuids, enable_compaction=True, incremental_stability=False) for uuid in uuids]
+            for t in range(300):
+                ## replica 3 dies after a while and holds everything after it back
+                i, j = rng.sample(range(3) if t < 60 else range(2), 2)
+                for group in (logs, full):
+                    group[i].add_node(t)
+                    self.swap_with_concurrent_ops(group[i], group[j])
+            self.assertGreater(len(logs[0].nodes), 200)
+            bit = logs[0]._replica_bits[3]
+
+            for group in (logs, full):
+                for log in group[:2]:
+                    log.remove_replica(3)
+                    self.assertEqual(log.other_replicas, [2 if log.my_uuid == 1 else 1])
+                    self.assertNotIn(3, log.other_replica_roots)
+                    self.assertLess(len(log.nodes), 10)
+            self.assertEqual(stable_nodes(logs[0]), stable_nodes(full[0]))
+            with self.assertRaises(ValueError):
+                logs[0].remove_replica(3)
+
+            ## replica 4 joins from replica 1's snapshot; 1 knows it holds what it exported, 2 knows nothing
+            snapshot, exported = logs[0].export_snapshot(), logs[0].roots
+            logs[2] = MerkleLog.from_snapshot(snapshot, 4, [1, 2, 4], enable_compaction=True)
+            logs[0].add_replica(4, exported)
+            logs[1].add_replica(4)
+            self.assertEqual(logs[0]._replica_bits[4], bit)
+            with self.assertRaises(ValueError):
+                logs[0].add_replica(2)
+            logs[0].add_node("waits for 4")
+            self.swap(logs[0], logs[1])
+            self.assertEqual([hash for hash in logs[0].roots if logs[0].nodes[hash].is_stable()], [])
+
+            compacted = logs[0].total_compacted
+            for t in range(200):
+                i, j = rng.sample(range(3), 2)
+                logs[i].add_node(("after", t))
+                self.swap_with_concurrent_ops(logs[i], logs[j])
+            self.assertGreater(logs[0].total_compacted, compacted)
+            self.assertLess(len(logs[0].nodes), 50)
+            for i, j in [(0, 1), (1, 2), (2, 0), (0, 1)]:
+                self.swap(logs[i], logs[j])
+            self.assertEqual(logs[0].roots, logs[1].roots)
+            self.assertEqual(logs[1].roots, logs[2].roots)
+
+            ## the replica set is recovered from storage with everything else
+            storage.close()
+            recovered = MerkleLog(1, uuids, enable_compaction=True, storage=SegmentLog(directory))
+            self.assertEqual(recovered, logs[0])
+            self.assertEqual(recovered.other_replica_roots, logs[0].other_replica_roots)
+            self.assertEqual(sorted(recovered.other_replicas), [2, 4])
+            self.assertEqual(stable_nodes(recovered), stable_nodes(logs[0]))
+            recovered.storage.close()
+
+    def test_vectorized_stability_recovery(self):
+
+        uuids = [1, 2, 3]
+        rng = random.Random(47)
+        options = dict(enable_compaction=True, incremental_stability=False, vectorized_stability=True)
+        with tempfile.TemporaryDirectory() as directory:
+            logs = [MerkleLog(1, uuids, storage=SegmentLog(directory), **options)] + [MerkleLog(uuid, uuids, **options) for uuid in uuids[1:]]
+            for t in range(400):
+                i, j = rng.sample(range(3), 2)
+                logs[i].add_node(t)
+                self.swap_with_concurrent_ops(logs[i], logs[j])
+            self.assertGreater(logs[0].total_compacted, 0)
+            logs[0].storage.close()
+
+            ## compactions replayed before stability is recovered must not leave rows behind
+            recovered = MerkleLog(1, uuids, storage=SegmentLog(directory), **options)
+            rows = recovered._vectorized._hashes[:len(recovered._vectorized)]
+            self.assertTrue(all(hash in recovered.nodes for hash in rows))
+            compacted = recovered.total_compacted
+            for t in range(60):
+                recovered.add_node(-t)
+                self.swap_with_concurrent_ops(recovered, logs[1 + t % 2])
+            self.assertGreater(recovered.total_compacted, compacted)
+            for hash, node in recovered.nodes.items():
+                if hash != recovered._get_genesis_node_hash():
+                    self.assertEqual(node.is_stable(), all(recovered.in_view(hash, uuid) for uuid in recovered.other_replicas))
+            recovered.storage.close()
+
+    def test_remove_replica_mid_swap(self):
+
+        uuids = [1, 2, 3]
+        log1, log2, log3 = [MerkleLog(uuid, uuids) for uuid in uuids]
+        for t in range(5):
+            log1.add_node(t)
+            log3.add_node(-t)
+
+        ## log1 evicts 3 while 3's reply is on its way: nothing from it is merged
+        nodes, roots = log1.prepare_swap(3)
+        reply, reply_roots, on_deliver = log3.respond_to_swap(1, nodes, roots)
+        log1.remove_replica(3)
+        held = set(log1.nodes)
+        with self.assertRaises(ValueError):
+            log1.swap_final(3, reply, reply_roots)
+        with self.assertRaises(ValueError):
+            log1.swap_final_stream(3, iter(reply.items()), reply_roots)
+        with self.assertRaises(ValueError):
+            log1.swap_final_many({ 2 : ({}, set(log2.roots)), 3 : (reply, reply_roots) })
+        self.assertEqual(set(log1.nodes), held)
+
+        ## 3 evicts 1 in turn before its reply is delivered, which then changes nothing
+        log3.remove_replica(1)
+        on_deliver()
+        self.assertNotIn(1, log3.other_replica_roots)
+
+        ## 3 carries on as a zombie; log1 turns it away
+        nodes, roots = log3.prepare_swap(2)
+        with self.assertRaises(ValueError):
+            log1.respond_to_swap(3, nodes, roots)
+        with self.assertRaises(ValueError):
+            log1.respond_to_swap_stream(3, iter(nodes.items()), roots)
+        self.assertEqual(set(log1.nodes), held)
+        self.swap(log1, log2)
+        self.assertEqual(log1.roots, log2.roots)
+
+    def test_reachability_index_recovery(self):
+
+        uuids = [1, 2]
+        log1, log2 = [MerkleLog(uuid, uuids) for uuid in uuids]
+        for t in range(30):
+            log1.add_node(t)
+            log2.add_node(-t)
+            if t % 4 == 0:
+                self.swap_with_concurrent_ops(log1, log2)
+        genesis = log1._get_genesis_node_hash()
+        live = { hash : node for hash, node in log1.nodes.items() if hash != genesis }
+
+        ## a log kept without the index may hold dependents before their dependencies; reopening it with the
+        ## index on must still label every node from its ancestors
+        with tempfile.TemporaryDirectory() as directory:
+            writer = MerkleLog(1, uuids, storage=SegmentLog(directory))
+            for hash in reversed(dependency_order(live)):
+                writer.storage.append_node(hash, live[hash], False)
+            writer.storage.append_roots(log1.roots)
+            writer.storage.close()
+
+            recovered = MerkleLog(1, uuids, storage=SegmentLog(directory), reachability_index=True)
+            self.assertEqual(set(recovered.reachability.label), set(live))
+            for a in live:
+                for b in live:
+                    self.assertEqual(recovered.happens_before(a, b), log1.happens_before(a, b))
+            recovered.storage.close()
+
+    def test_filtered_swap(self):
+
+        uuids = [1, 2, 3]
+        log1, log2, log3 = [MerkleLog(uuid, uuids) for uuid in uuids]
+        shared = [log1.add_node(t) for t in range(5)]
+        self.swap_with_concurrent_ops(log1, log3)
+        own = log1.add_node("own")
+
+        ## log2 learned the shared nodes from log3, which log1 can't know; its filter stops log1's walk there
+        self.swap_with_concurrent_ops(log2, log3)
+        held = log2.held_filter()
+        self.assertEqual(BloomFilter.from_bytes(held.to_bytes()).data, held.data)
+        nodes, roots = log1.prepare_swap(2, peer_filter=held)
+        self.assertEqual(set(nodes), {own})
+        self.assertTrue(set(shared) <= set(log1.prepare_swap(2)[0]))
+
+        ## a false positive on a node log2 never had is caught before anything changes
+        everything = BloomFilter(64, 1, b"\xff" * 8)
+        before = (dict(log2.dependencies), tuple(log2.roots))
+        nodes, roots = log1.prepare_swap(2, peer_filter=everything)
+        with self.assertRaises(IncompleteDelta) as raised:
+            log2.respond_to_swap(1, nodes, roots, own_filter=everything)
+        self.assertEqual(raised.exception.missing, {own})
+        self.assertEqual((dict(log2.dependencies), tuple(log2.roots)), before)
+
+        ## with a very lossy filter, retries still converge to what plain swaps produce
+        rng = random.Random(17)
+        for t in range(200):
+            i = rng.randrange(3)
+            logs = [log1, log2, log3]
+            if rng.random() < 0.5:
+                logs[i].add_node(t)
+            else:
+                swap_reconciled(logs[i], logs[(i + 1 + rng.randrange(2)) % 3], false_positive_rate=0.3)
+        for a, b in [(log1, log2), (log2, log3), (log3, log1), (log1, log2)]:
+            nodes, roots = a.prepare_swap(b.my_uuid)
+            nodes, roots, on_deliver = b.respond_to_swap(a.my_uuid, nodes, roots)
+            a.swap_final(b.my_uuid, nodes, roots)
+            on_deliver()
+        self.assertEqual(set(log1.nodes), set(log2.nodes))
+        self.assertEqual(set(log2.nodes), set(log3.nodes))
+
+
+    def test_compact_store_matches_dict_store(self):
+        
+        uuids = [1, 2, 3]
+        rng = random.Random(11)
+        
+        plain = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        compact = [MerkleLog(uuid, uuids, enable_compaction=True, compact_store=True) for uuid in uuids]
+        
+        genesis_node = compact[0]._get_genesis_node_hash()
+        self.assertEqual(compact[0].dependencies, {genesis_node: []})
+        self.assertEqual(compact[0], plain[0])
+        
+        for t in range(300):
+            i = rng.randrange(3)
+            if rng.random() < 0.6:
+                value = plain[i].my_uuid * 1000 + t
+                plain[i].add_node(value)
+                compact[i].add_node(value)
+            else:
+                j = rng.choice([j for j in range(3) if j != i])
+                self.swap_with_concurrent_ops(plain[i], plain[j])
+                self.swap_with_concurrent_ops(compact[i], compact[j])
+            
+            for a, b in zip(plain, compact):
+                self.assertEqual(a, b)
+                self.assertEqual(a.compacted, b.compacted)
+                self.assertEqual(set(a.nodes), set(b.nodes))
+                self.assertEqual(len(a.nodes), len(b.nodes))
+                for hash, node in a.nodes.items():
+                    self.assertEqual(node.value, b.nodes[hash].value)
+                    self.assertEqual(node.is_stable(), b.nodes[hash].is_stable())
+        
+        ## ids of deleted nodes are recycled, so the interning table only covers what the log still references
+        store = compact[0].nodes._store
+        referenced = set(compact[0].nodes) | set(compact[0].dependencies) | set(compact[0].dependents)
+        for deps in compact[0].dependencies.values():
+            referenced.update(deps)
+        self.assertEqual(set(store._ids), referenced)
+
+        ## inserting a node writes its dependencies once, so the flat array holds no garbage without deletions
+        log = MerkleLog(1, uuids, compact_store=True)
+        for t in range(3000):
+            log.add_node(t)
+        log.add_nodes(range(500))
+        self.swap(log, MerkleLog(2, uuids, compact_store=True))
+        self.assertEqual(len(log.nodes._store._dep_ids), sum(len(deps) for deps in log.dependencies.values()))
+
+        ## a handle to a compacted node whose id is still referenced fails like one whose id was recycled
+        hash = next(hash for hash in compact[0].nodes if compact[0].dependents.get(hash))
+        node = compact[0].nodes[hash]
+        compact[0].nodes.pop(hash)
+        self.assertIn(hash, compact[0].dependencies)
+        with self.assertRaises(KeyError):
+            node.dependencies
+        with self.assertRaises(KeyError):
+            node.is_stable()
+
+
+    def test_wide_fanout_dependents(self):
+
+        uuids = [1, 2]
+        source = MerkleLog(2, uuids)
+        genesis = source._get_genesis_node_hash()
+        children = [source._make_node((genesis,), i) for i in range(300)]
+        nodes = {child.digest: child for child in children}
+
+        plain = MerkleLog(1, uuids)
+        compact = MerkleLog(1, uuids, compact_store=True)
+        for log in (plain, compact):
+            log.swap_final(2, nodes, set(nodes))
+            ## children are kept in arrival order and compare like the plain dict
+            self.assertEqual(list(log.dependents[genesis]), list(nodes))
+        self.assertEqual(plain, compact)
+
+        for log in (plain, compact):
+            log.compact_log({genesis})
+            log.compact_log(set(nodes))
+            self.assertNotIn(genesis, log.dependents)
+            self.assertEqual(log.compacted, set(nodes))
+        self.assertEqual(plain, compact)
+
+
+    def test_content_hashing(self):
+        
+        uuids = [1, 2]
+        log1 = MerkleLog(1, uuids)
+        log2 = MerkleLog(2, uuids, hasher=sha256_hasher)
+        
+        ## digests are process-stable, so this is the same genesis on every run
+        self.assertEqual(log1._get_genesis_node_hash().hex(), "5044955245ceb6d53b23e5f955d84600cc4deb2747e9b6d5feac19470de749c2")
+        self.assertEqual(len(log2._get_genesis_node_hash()), 32)
+        self.assertNotEqual(log1._get_genesis_node_hash(), log2._get_genesis_node_hash())
+        
+        self.assertNotEqual(MerkleLog(1, uuids).add_node("10"), MerkleLog(1, uuids).add_node(10))
+        self.assertEqual(MerkleLog(1, uuids).add_node((1, "a")), MerkleLog(2, uuids).add_node((1, "a")))
+        
+        legacy = MerkleLog(1, uuids, hasher=builtin_hasher)
+        self.assertIsInstance(legacy.add_node(10), int)
+
+        ## nesting is capped on both sides, so a hostile payload can't exhaust the stack
+        nested = ()
+        for _ in range(MAX_DEPTH - 1):
+            nested = (nested,)
+        self.assertEqual(decode_value(encode_value(nested), 0), (nested, len(encode_value(nested))))
+        with self.assertRaises(ValueError):
+            log1.add_node((nested,))
+        with self.assertRaises(ValueError):
+            decode_value(b"L\x01" * 100000 + b"N", 0)
+
+        ## values without a canonical encoding are refused before anything is added
+        roots = log1.roots
+        for value in ({"a": 1}, {1, 2}, (1, object())):
+            with self.assertRaises(TypeError):
+                log1.add_node(value)
+            with self.assertRaises(TypeError):
+                sha256_hasher([], value)
+        self.assertEqual(log1.roots, roots)
+    
+    def test_verify_delta_hashes_only_new_nodes(self):
+        
+        calls = []
+        def counting_hasher(dependencies, value):
+            calls.append(value)
+            return blake2b_hasher(dependencies, value)
+        
+        uuids = [1, 2]
+        log1 = MerkleLog(1, uuids)
+        log2 = MerkleLog(2, uuids, hasher=counting_hasher)
+        
+        log1.add_node(10)
+        log1.add_node(11)
+        self.swap(log1, log2)
+        log1.add_node(12)
+        
+        nodes_to_send, roots_to_send = log1.prepare_swap(2)
+        ## resend an ancestor log2 already holds alongside the new node
+        nodes_to_send.update({hash: log1.nodes[hash] for hash in log2.nodes if hash in log1.nodes})
+        
+        del calls[:]
+        log2.respond_to_swap(1, nodes_to_send, roots_to_send)
+        self.assertEqual(calls, [12])
+        
+        tampered = log1.add_node(13)
+        nodes_to_send, roots_to_send = log1.prepare_swap(2)
+        nodes_to_send[tampered] = log1._make_node(log1.nodes[tampered].dependencies, 14)
+        with self.assertRaises(BadDelta) as raised:
+            log2.respond_to_swap(1, nodes_to_send, roots_to_send)
+        self.assertEqual(raised.exception.hash, tampered)
+        self.assertFalse(tampered in log2.nodes)
+
+    def test_parallel_verify_delta(self):
+        
+        uuids = [1, 2]
+        source = MerkleLog(1, uuids)
+        for i in range(50):
+            source.add_node(i)
+        nodes_to_send, roots_to_send = source.prepare_swap(2)
+        tampered = sorted(nodes_to_send)[25]
+        bad_nodes = dict(nodes_to_send)
+        bad_nodes[tampered] = source._make_node(nodes_to_send[tampered].dependencies, -1)
+        
+        for executor_type in [ThreadPoolExecutor, ProcessPoolExecutor]:
+            with executor_type(2) as executor:
+                receiver = MerkleLog(2, uuids, verify_executor=executor, verify_chunk=8)
+                with self.assertRaises(BadDelta) as raised:
+                    receiver.respond_to_swap(1, bad_nodes, roots_to_send)
+                self.assertEqual(raised.exception.hash, tampered)
+                self.assertEqual(len(receiver.nodes), 1)
+                
+                receiver.respond_to_swap(1, nodes_to_send, roots_to_send)
+                self.assertEqual(set(receiver.nodes), set(source.nodes))
+
+
+    def wire_swap(self, log1, log2):
+        nodes_to_send, roots_to_send = decode_delta(encode_delta(*log1.prepare_swap(log2.my_uuid)))
+        nodes_to_send2, roots_to_send2, on_deliver = log2.respond_to_swap(log1.my_uuid, nodes_to_send, roots_to_send)
+        nodes_to_send2, roots_to_send2 = decode_delta(encode_delta(nodes_to_send2, roots_to_send2))
+        log1.swap_final(log2.my_uuid, nodes_to_send2, roots_to_send2)
+        on_deliver()
+    
+    def test_wire_format_round_trip(self):
+        
+        uuids = [1, 2, 3]
+        logs = [MerkleLog(uuid, uuids) for uuid in uuids]
+        wired = [MerkleLog(uuid, uuids) for uuid in uuids]
+        
+        values = [None, True, -5, 2 ** 80, 1.25, "caf\u00e9", b"\x00\xff", (1, ("nested", b"")), 10]
+        for i, value in enumerate(values):
+            logs[i % 3].add_node(value)
+            wired[i % 3].add_node(value)
+        
+        for a, b in [(0, 1), (1, 2), (2, 0), (0, 1)]:
+            self.swap(logs[a], logs[b])
+            self.wire_swap(wired[a], wired[b])
+        
+        for log, wired_log in zip(logs, wired):
+            self.assertEqual(log, wired_log)
+            self.assertEqual(log.other_replica_roots, wired_log.other_replica_roots)
+            self.assertEqual({h: n.value for h, n in log.nodes.items()}, {h: n.value for h, n in wired_log.nodes.items()})
+        
+        log = MerkleLog(1, uuids)
+        log.add_node("x")
+        payload = encode_delta(*log.prepare_swap(2))
+        nodes, roots = decode_delta(memoryview(bytearray(payload)))
+        self.assertEqual(roots, set(log.roots))
+        self.assertEqual(set(nodes), set(log.prepare_swap(2)[0]))
+        
+        for broken in (payload[:-1], payload[:10], payload + b"\x00", b"XYZ" + payload[3:]):
+            with self.assertRaises(ValueError):
+                decode_delta(broken)
+        
+        legacy = MerkleLog(1, uuids, hasher=builtin_hasher)
+        legacy.add_node(1)
+        with self.assertRaises(TypeError):
+            encode_delta(*legacy.prepare_swap(2))
+
+
+    def test_compaction_deletes_for_good(self):
+
+        uuids = [1, 2, 3]
+        logs = [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids]
+        for t in range(5):
+            logs[0].add_node(t)
+        stale, _ = logs[0].prepare_swap(2)
+        rng = random.Random(1)
+        for t in range(300):
+            i, j = rng.sample(range(3), 2)
+            logs[i].add_node(t)
+            self.swap(logs[i], logs[j])
+
+        ## a compacted node is deleted once its last dependent is compacted, not kept in compacted forever
+        log = logs[1]
+        self.assertLess(len(log.compacted), 10)
+        self.assertLessEqual(set(log.dependencies), set(log.nodes) | log.compacted)
+        self.assertTrue(all(log.is_deleted(hash) for hash in stale))
+
+        ## a peer with stale knowledge of us resends deleted nodes under a new one; they are not taken back
+        logs[0].add_node("new")
+        nodes, roots = logs[0].prepare_swap(2)
+        log.swap_final(1, {**stale, **nodes}, roots)
+        self.assertTrue(all(log.is_deleted(hash) for hash in stale))
+        self.assertTrue(all(log._exists(hash) for hash in nodes))
+
+    def test_segment_log_recovery(self):
+        
+        uuids = [1, 2, 3]
+        rng = random.Random(5)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            storage = SegmentLog(directory, segment_bytes=2048)
+            logs = [MerkleLog(1, uuids, enable_compaction=True, storage=storage)] + [MerkleLog(uuid, uuids, enable_compaction=True) for uuid in uuids[1:]]
+            
+            for t in range(400):
+                i = rng.randrange(3)
+                if rng.random() < 0.5:
+                    logs[i].add_node(("value", t))
+                else:
+                    j = rng.choice([j for j in range(3) if j != i])
+                    self.swap_with_concurrent_ops(logs[i], logs[j])
+            
+            log = logs[0]
+            self.assertGreater(log.total_compacted, 0)
+            ## segments whose nodes were all deleted by compaction are gone
+            self.assertLess(len(storage.segments()), storage._segment + 1)
+            storage.close()
+            
+            recovered_storage = SegmentLog(directory)
+            recovered = MerkleLog(1, uuids, enable_compaction=True, storage=recovered_storage)
+            self.assertEqual(recovered, log)
+            self.assertEqual(recovered.compacted, log.compacted)
+            self.assertEqual(recovered.other_replica_roots, log.other_replica_roots)
+            self.assertEqual(recovered.total_compacted, log.total_compacted)
+            self.assertEqual({h: (n.value, n.is_stable()) for h, n in recovered.nodes.items()}, {h: (n.value, n.is_stable()) for h, n in log.nodes.items()})
+            ## compactions replayed ahead of stability recovery leave nothing behind in the per-peer pending sets
+            for pending in recovered._pending_send.values():
+                self.assertLessEqual(pending, set(recovered.nodes))
+            self.assertEqual(recovered._pending_send, log._pending_send)
+            
+            ## the recovered replica keeps gossiping and persisting
+            self.swap_with_concurrent_ops(recovered, logs[1])
+            last = recovered.add_node("after restart")
+            recovered_storage.close()
+            
+            ## a torn write at the tail is dropped on the next start
+            newest = os.path.join(directory, "%012d.seg" % recovered_storage.segments()[-1])
+            with open(newest, "ab") as f:
+                f.write(b"n\x40partial")
+            again = MerkleLog(1, uuids, storage=SegmentLog(directory))
+            self.assertEqual(again, recovered)
+            self.assertEqual(again.roots, [last])
+            self.assertEqual(again.storage.read_node(last), (tuple(recovered.dependencies[last]), "after restart"))
+
+            ## records reach the file as they are appended, so a process that dies without close() loses none
+            unsynced = again.add_node("before crash")
+            crashed = MerkleLog(1, uuids, storage=SegmentLog(directory))
+            self.assertEqual(crashed.roots, [unsynced])
+            crashed.storage.close()
+            again.storage.close()
+
+
     def swap_with_concurrent_ops(self, log1, log2):
 
             nodes_to_send, roots_to_send = log1.prepare_swap(log2.my_uuid)
@@ -857,89 +2016,24 @@ class MerkleLogTests(unittest.TestCase):
 
 
 
-    def test_benchmark(self):
-        
-            uuids = [1, 2, 3, 4, 5]
-            id1, id2, id3, id4, id5 = uuids  
-            
-            log1 = MerkleLog(id1, uuids, enable_compaction=True)
-            log2 = MerkleLog(id2, uuids, enable_compaction=True)
-            log3 = MerkleLog(id3, uuids, enable_compaction=True)
-            log4 = MerkleLog(id4, uuids, enable_compaction=True)
-            log5 = MerkleLog(id5, uuids, enable_compaction=True)
+    def test_simulation_smoke(self):
 
-            
-            ops_to_gossip = 300
-            
-            logs = [log1, log2, log3, log4, log5]
-            
-            timesteps = [59,119,179,239, 299]
-            average_nodes_in_log = [[], [], [], [], []]
-            average_nodes_compacted = [[], [], [], [], []]
-            
-            
-            def next_step():
-                for i in range(5):
-                    timesteps[i] += 1
-                    average_nodes_in_log[i].append( len(logs[i].nodes.keys()) )
-                    average_nodes_compacted[i].append( len(logs[i].compacted) )
-            
-            swaps = 0
-            total_ops = 0
-            for t in range(25000):
-         
-                node_1_down = timesteps[0] < 6000 and timesteps[0] > 4000
-                 
-                num = np.random.random_integers(0, 3)
-                total_ops += num
-                for _ in range(num):
-                    i = np.random.random_integers(0, 3) 
-                    # if not node_1_down or i not in [1,2,3]:
-                    logs[i].add_node(logs[i].my_uuid * 1000)
-                    # visualize_multiple(logs)
-                
-                       
-                for i in range(5):
-                    
-                    if timesteps[i] % ops_to_gossip == 0:
-                        logs[i].add_node(logs[i].my_uuid * 1000)
-
-                        for j in list(filter(lambda x : x != i,[0,1,2,3, 4])):
-                            
-                            if not node_1_down or (1 not in [i,j] and 2 not in [i,j] and 3 not in [i,j]):
-                            
-
-                                self.swap_with_concurrent_ops(logs[i], logs[j])
-                                total_ops += 1
-                        
-                        timesteps[i] += np.random.random_integers(0, 2) 
-                        logs[i].add_node(logs[i].my_uuid * 1000)
+        options = dict(replicas=5, steps=2000, gossip_every=120, partitions=((600, 1000, (1, 2, 3)),), seed=3, sample_every=5)
+        result = simulate(**options)
 
-                        total_ops += 1
-                next_step()
-            
-            
-            total = range(25000)
-            print(list(map(lambda x : x.total_compacted, logs)))
-            print(total_ops)
-            nodes_in_log = (np.array(average_nodes_in_log))
-            plt.plot(total,nodes_in_log[0])
-            plt.plot(total,nodes_in_log[1])
-            plt.plot(total,nodes_in_log[2])
-            plt.plot(total,nodes_in_log[3])
-            plt.plot(total,nodes_in_log[4])
+        self.assertEqual(result["config"]["seed"], 3)
+        self.assertGreater(result["ops"], 0)
+        self.assertGreater(result["swaps"], 0)
+        self.assertLessEqual(result["swap_latency_p50_us"], result["swap_latency_p99_us"])
+        self.assertGreaterEqual(result["peak_nodes"], result["steady_nodes"])
+        self.assertTrue(all(c > 0 for c in result["total_compacted"]))
+        json.dumps(result)
+
+        ## seeded: the same workload runs again op for op
+        again = simulate(**options)
+        for key in ("ops", "swaps", "peak_nodes", "steady_nodes", "total_compacted"):
+            self.assertEqual(result[key], again[key])
 
-            plt.show()
-            
-            
-            # print(np.array(average_nodes_compacted) / 5000)
-        
-            
-            
-               
 
-               
-           
-           
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
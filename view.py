@@ -0,0 +1,136 @@
+import bisect
+import heapq
+
+
+class OrderedView:
+    ## Deterministic total order of the log's values: the topological order that always takes the smallest
+    ## ready hash (Kahn's algorithm with a min-heap), so replicas holding the same nodes read the same
+    ## sequence. New nodes are merged in as they arrive. Everything before the first position where one of
+    ## them would have been picked stays put; only the tail after it is re-sorted, which for local writes
+    ## and merges of recent concurrent work is a short suffix. Dependencies outside the view (genesis,
+    ## nodes compacted before a snapshot was loaded) count as already placed.
+    ## New nodes descend from every stable one, so compacted nodes never move again. Once the entries
+    ## up to some position are all compacted (forget) the view lets go of them: positions keep counting from
+    ## the start, but only entries from `offset` on can be read, and a reader that hasn't applied them yet
+    ## gets a ValueError from changes_since instead.
+
+    def __init__(self):
+        self._order = []            # position - offset -> hash
+        self._position = {}         # hash -> position, for entries still held
+        self._nodes = {}            # hash -> node, for entries still held
+        self.offset = 0             # entries before this position were compacted and dropped
+        self._forgotten = set()     # compacted hashes at or after offset, dropped once everything before them is
+        self.version = 0
+        self._rewinds = []          # (version, position) for every insert that re-sorted already placed entries
+        self._floor = 0             # cursors from before this version may predate a rewind no longer kept
+
+    def __len__(self):
+        return self.offset + len(self._order)
+
+    def __contains__(self, hash):
+        return hash in self._position
+
+    def __iter__(self):
+        for hash in self._order:
+            yield self._nodes[hash].value
+
+    def index(self, hash):
+        return self._position[hash]
+
+    def entries(self, start = None):
+        ## (hash, value) from position start on, by default from the first entry still held
+        if start is None:
+            start = self.offset
+        elif start < self.offset:
+            raise ValueError("entries before position %d were compacted" % self.offset)
+        nodes = self._nodes
+        for hash in self._order[start - self.offset:]:
+            yield hash, nodes[hash].value
+
+    def cursor(self):
+        return self.version, len(self)
+
+    def changes_since(self, cursor):
+        ## returns (keep, entries, cursor): a reader that had applied everything up to `cursor` keeps its
+        ## first `keep` entries, drops the rest and applies `entries` to be at the returned cursor
+        version, length = cursor
+        keep = length
+        ## the rewind recorded by the insert that produced `version` is already in what the reader applied
+        for _, position in self._rewinds[bisect.bisect_left(self._rewinds, (version + 1, -1)):]:
+            keep = min(keep, position)
+        if keep < self.offset or version < self._floor:
+            raise ValueError("cursor %r is behind entries the view has dropped" % (cursor,))
+        return keep, list(self.entries(keep)), self.cursor()
+
+    def forget(self, hashes):
+        ## hashes were compacted: drop the entries in front that are now all compacted, and the rewinds
+        ## that only a reader behind them could need
+        self._forgotten.update(hash for hash in hashes if hash in self._position)
+        order, forgotten = self._order, self._forgotten
+        dropped = 0
+        while dropped < len(order) and order[dropped] in forgotten:
+            hash = order[dropped]
+            forgotten.discard(hash)
+            del self._position[hash]
+            del self._nodes[hash]
+            dropped += 1
+        if not dropped:
+            return
+        del order[:dropped]
+        self.offset += dropped
+        rewinds = self._rewinds
+        last = max((i for i, (_, position) in enumerate(rewinds) if position < self.offset), default=None)
+        if last is not None:
+            self._floor = rewinds[last][0]
+            del rewinds[:last + 1]
+
+    def insert(self, items):
+        ## items: (hash, node) pairs, in any order; every dependency must be in the view, in items or
+        ## outside the view for good
+        order, position, offset = self._order, self._position, self.offset
+        batch = { hash : node for hash, node in items if hash not in position }
+        if not batch:
+            return
+        self.version += 1
+
+        ## the first position where some new node would be ready and smaller than what was placed there
+        length = cut = len(self)
+        for hash, node in batch.items():
+            if any(d in batch for d in node.dependencies):
+                continue
+            k = max((position[d] + 1 for d in node.dependencies if d in position), default=offset)
+            while k < cut and order[k - offset] < hash:
+                k += 1
+            cut = min(cut, k)
+        if cut < length:
+            self._rewinds.append((self.version, cut))
+
+        tail = order[cut - offset:]
+        del order[cut - offset:]
+        for hash in tail:
+            del position[hash]
+        self._nodes.update(batch)
+        pending = dict.fromkeys(tail)
+        pending.update(dict.fromkeys(batch))
+
+        waiting, dependents, ready = {}, {}, []
+        for hash in pending:
+            unplaced = 0
+            for d in dict.fromkeys(self._nodes[hash].dependencies):
+                if d in pending:
+                    unplaced += 1
+                    dependents.setdefault(d, []).append(hash)
+            if unplaced:
+                waiting[hash] = unplaced
+            else:
+                ready.append(hash)
+        heapq.heapify(ready)
+        while ready:
+            hash = heapq.heappop(ready)
+            position[hash] = offset + len(order)
+            order.append(hash)
+            for dependent in dependents.get(hash, ()):
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    del waiting[dependent]
+                    heapq.heappush(ready, dependent)